@@ -0,0 +1,311 @@
+"""
+Stage-level benchmarks over the sample schedules.
+
+Every pipeline stage is run on its own against planering.pdf, planering72.pdf, schema_pic.png and scaled up
+copies of them. The number of Tesseract calls, the number of pdfplumber table finder calls and the peak memory
+allocated by Python and NumPy are compared with benchmark_baseline.json and regressions are flagged. They do not
+depend on the machine, so the baseline can be shared. Wall times (best of several runs) are only compared when
+the baseline has them, e.g. one saved with --with-timings on the same machine.
+
+Usage:
+    python benchmark.py                                 # compare with the baseline, exit with 1 on a regression
+    python benchmark.py --save-baseline                 # store the counts as the new baseline
+    python benchmark.py --save-baseline --with-timings \
+        --baseline local_baseline.json                  # also store the wall times, for this machine only
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import pdfplumber.page
+import pytesseract
+
+import cal_functions
+import pdf_processing
+import png_processing
+from layout_templates import LayoutStore
+from ocr_cache import ocr_cache
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.path.join(DIRECTORY, 'benchmark_baseline.json')
+
+PDF_SAMPLES = ['planering.pdf', 'planering72.pdf']
+PNG_SAMPLE = 'schema_pic.png'
+PNG_SIGN = 'DOF'
+# The screenshot is also benchmarked at these scales
+PNG_SCALES = [2, 4]
+# The shifts of the PDFs are also converted and serialized repeated this many times
+SHIFT_REPEATS = [20]
+
+# A stage has regressed if it is this much slower or uses this much more memory than the baseline.
+# Wall times of the PDF stages vary by up to a third between runs on a busy machine.
+TIME_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.25
+# Differences below these are noise
+MIN_TIME_DIFFERENCE = 0.02
+MIN_MEMORY_DIFFERENCE = 64 * 1024
+
+
+def measure(function, repeat):
+    """
+    Run a stage and measure it.
+
+    :param function: callable
+        The stage, called without arguments.
+    :param repeat: int
+        The number of timed runs, the fastest one is reported.
+
+    :return: dict
+        The seconds of the fastest run, the peak traced memory in bytes and the Tesseract and table finder calls
+        of one run.
+    """
+    # Count the table finder calls of pdfplumber, extract_tables and cropped pages go through it as well
+    find_tables = pdfplumber.page.Page.find_tables
+    table_finder_calls = [0]
+
+    def counted_find_tables(self, *args, **kwargs):
+        table_finder_calls[0] += 1
+        return find_tables(self, *args, **kwargs)
+
+    # Peak memory is measured on a separate run, since tracing allocations slows the stage down
+    calls_before = png_processing.ocr_call_stats['calls']
+    pdfplumber.page.Page.find_tables = counted_find_tables
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        pdfplumber.page.Page.find_tables = find_tables
+    ocr_calls = png_processing.ocr_call_stats['calls'] - calls_before
+
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+
+    return {'seconds': min(seconds), 'peak_memory': peak_memory, 'ocr_calls': ocr_calls,
+            'table_finder_calls': table_finder_calls[0]}
+
+
+def tesseract_available():
+    try:
+        pytesseract.get_tesseract_version()
+        return True
+    except (pytesseract.TesseractNotFoundError, OSError):
+        return False
+
+
+def png_stages(name, gray_image, repeat):
+    # Line detection, merging and cell building on a grayscale screenshot
+    _, binary_image = cv2.threshold(gray_image, 150, 255, cv2.THRESH_BINARY_INV)
+    horizontal_lines, vertical_lines = png_processing.detect_lines(binary_image)
+    merged_horizontal_lines = png_processing.merge_lines(horizontal_lines, True)
+    merged_vertical_lines = png_processing.merge_lines(vertical_lines, False)
+
+    def build_cells(engine):
+        cells = png_processing.build_cells(merged_horizontal_lines, merged_vertical_lines, binary_image.shape, engine)
+        return png_processing.GridIndex(png_processing.filter_cells_by_dimensions(cells, 10, 10))
+
+    cells = png_processing.filter_cells_by_dimensions(
+        png_processing.get_cells(merged_horizontal_lines, merged_vertical_lines), 10, 10)
+
+    def screen_empty_cells():
+        # The integral images are part of the stage, so forget the ones of the last run
+        png_processing.page_states.clear()
+        return png_processing.find_empty_cells(gray_image, cells)
+
+    results = {}
+    factor = round(png_processing.get_image_scale(binary_image))
+    if factor >= 2:
+        results[f'{name}/detect_lines_pyramid'] = measure(
+            lambda: png_processing.detect_lines_pyramid(binary_image, factor), repeat)
+
+    results.update({
+        f'{name}/threshold': measure(
+            lambda: cv2.threshold(gray_image, 150, 255, cv2.THRESH_BINARY_INV), repeat),
+        f'{name}/detect_lines': measure(lambda: png_processing.detect_lines(binary_image), repeat),
+        f'{name}/merge_lines': measure(lambda: (png_processing.merge_lines(horizontal_lines, True),
+                                                png_processing.merge_lines(vertical_lines, False)), repeat),
+        f'{name}/build_cells': measure(lambda: build_cells('grid'), repeat),
+        f'{name}/build_cells_components': measure(lambda: build_cells('components'), repeat),
+        f'{name}/screen_empty_cells': measure(screen_empty_cells, repeat),
+    })
+    return results
+
+
+def ocr_stage(name, image_path):
+    # The whole screenshot pipeline of one signature with an empty OCR cache, so every cell is read
+    def run():
+        ocr_cache.clear()
+        png_processing.return_work_shifts_and_working_keys(PNG_SIGN, image_path)
+
+    result = measure(run, 1)
+    ocr_cache.clear()
+    return {f'{name}/ocr': result}
+
+
+def pdf_stages(name, path, repeat):
+    results = {}
+
+    def extract_all():
+        return pdf_processing.return_work_shifts_for_signs(path)
+
+    # Table extraction with pdfplumber's table finder, and with a layout that has been seen before
+    pdf_processing.USE_LAYOUT_TEMPLATES = False
+    results[f'{name}/extract_tables'] = measure(extract_all, repeat)
+    pdf_processing.USE_LAYOUT_TEMPLATES = True
+    layout_store = pdf_processing.layout_store
+    pdf_processing.layout_store = LayoutStore()
+    try:
+        extract_all()
+        results[f'{name}/extract_tables_template'] = measure(extract_all, repeat)
+    finally:
+        pdf_processing.layout_store = layout_store
+
+    schedule = extract_all()
+    for times in [1] + SHIFT_REPEATS:
+        suffix = '' if times == 1 else f' x{times}'
+        signs = [(work_shifts * times, working_hours_dict)
+                 for work_shifts, working_hours_dict in schedule.values()]
+        shifts = [cal_functions.build_shifts(work_shifts, working_hours_dict)
+                  for work_shifts, working_hours_dict in signs]
+
+        def convert():
+            # The memoized key and date parsing is part of the stage
+            cal_functions.parse_key_time_range.cache_clear()
+            cal_functions.parse_day_month.cache_clear()
+            return [cal_functions.build_shifts(work_shifts, working_hours_dict)
+                    for work_shifts, working_hours_dict in signs]
+
+        results[f'{name}{suffix}/convert_shifts'] = measure(convert, repeat)
+        results[f'{name}{suffix}/serialize_ics'] = measure(
+            lambda: [''.join(cal_functions.generate_ics(sign_shifts)) for sign_shifts in shifts], repeat)
+    return results
+
+
+def run_benchmarks(repeat=5, with_ocr=True):
+    # Print nothing from the stages, only the results
+    results = {}
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        png_processing.USE_LAYOUT_TEMPLATES = False
+
+        gray_image = cv2.imread(os.path.join(DIRECTORY, PNG_SAMPLE), cv2.IMREAD_GRAYSCALE)
+        results.update(png_stages(PNG_SAMPLE, gray_image, repeat))
+        for scale in PNG_SCALES:
+            scaled_image = cv2.resize(gray_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+            results.update(png_stages(f'{PNG_SAMPLE} x{scale}', scaled_image, repeat))
+
+        if with_ocr:
+            results.update(ocr_stage(PNG_SAMPLE, os.path.join(DIRECTORY, PNG_SAMPLE)))
+
+        for sample in PDF_SAMPLES:
+            results.update(pdf_stages(sample, os.path.join(DIRECTORY, sample), repeat))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        png_processing.USE_LAYOUT_TEMPLATES = True
+    return results
+
+
+# The counts that are stored in the baseline. They must never grow.
+COUNTS = ['ocr_calls', 'table_finder_calls']
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE):
+    """
+    Compare the results with the baseline.
+
+    :return: list
+        A description of every regression. Stages that are not in the baseline are not compared,
+        see missing_stages.
+    """
+    regressions = []
+    for stage, result in results.items():
+        base = baseline.get(stage)
+        if base is None:
+            continue
+        if 'seconds' in base and result['seconds'] > base['seconds'] * (1 + time_tolerance) and \
+                result['seconds'] - base['seconds'] > MIN_TIME_DIFFERENCE:
+            regressions.append(f"{stage}: {result['seconds']:.4f} s, baseline {base['seconds']:.4f} s")
+        if result['peak_memory'] > base['peak_memory'] * (1 + MEMORY_TOLERANCE) and \
+                result['peak_memory'] - base['peak_memory'] > MIN_MEMORY_DIFFERENCE:
+            regressions.append(f"{stage}: {result['peak_memory'] / 1e6:.1f} MB peak memory, "
+                               f"baseline {base['peak_memory'] / 1e6:.1f} MB")
+        for count in COUNTS:
+            if result[count] > base.get(count, 0):
+                regressions.append(f"{stage}: {result[count]} {count}, baseline {base.get(count, 0)}")
+    return regressions
+
+
+def missing_stages(results, baseline):
+    """
+    Get the stages that have no baseline, e.g. new stages or the OCR stage on the first machine with Tesseract.
+
+    :return: list
+        The names of the stages.
+    """
+    return [stage for stage in results if stage not in baseline]
+
+
+def print_results(results, baseline):
+    print(f"{'stage':<52}{'seconds':>10}{'baseline':>10}{'peak MB':>10}{'ocr calls':>11}{'finder calls':>14}")
+    for stage, result in results.items():
+        base = baseline.get(stage) or {}
+        base_seconds = f"{base['seconds']:.4f}" if 'seconds' in base else '-'
+        print(f"{stage:<52}{result['seconds']:>10.4f}{base_seconds:>10}"
+              f"{result['peak_memory'] / 1e6:>10.1f}{result['ocr_calls']:>11}{result['table_finder_calls']:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on the sample schedules.")
+    parser.add_argument('--save-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--with-timings', action='store_true',
+                        help="also store the wall times in the baseline, which only hold for this machine")
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="the baseline JSON file")
+    parser.add_argument('--repeat', type=int, default=5, help="the number of timed runs per stage")
+    parser.add_argument('--tolerance', type=float, default=TIME_TOLERANCE,
+                        help="the share a stage may be slower than the baseline before it is flagged")
+    parser.add_argument('--no-ocr', action='store_true', help="skip the stages that run Tesseract")
+    args = parser.parse_args()
+
+    with_ocr = not args.no_ocr and tesseract_available()
+    if not args.no_ocr and not with_ocr:
+        print("Tesseract is not installed, skipping the OCR stages.")
+
+    results = run_benchmarks(args.repeat, with_ocr)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        # Keep the baseline of stages that were skipped this time
+        baseline.update({stage: {key: value for key, value in result.items()
+                                 if key != 'seconds' or args.with_timings}
+                         for stage, result in results.items()})
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+
+    for stage in missing_stages(results, baseline):
+        print(f"NO BASELINE {stage}: run with --save-baseline to add it")
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
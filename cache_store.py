@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+
+class LruDict:
+    """
+    A dict that holds at most max_entries items and drops the least recently used one first.
+
+    It has no lock of its own, the caches that use it already hold one around every call.
+    """
+
+    def __init__(self, max_entries, items=()):
+        self.max_entries = max_entries
+        self.entries = OrderedDict(items)
+        self._trim()
+
+    def _trim(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Get an item and mark it as the most recently used one"""
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def set(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self._trim()
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        self.entries.clear()
+
+    def items(self):
+        """The items from the least to the most recently used one"""
+        return list(self.entries.items())
+
+
+def write_json(path, data):
+    """
+    Write data to a JSON file.
+
+    The data is written to a temporary file in the same directory first and moved over the file, so other
+    processes never read a half written file.
+
+    :raises OSError: if the file can not be written. No temporary file is left behind.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+        os.replace(temp_path, path)
+    except OSError:
+        remove_file(temp_path)
+        raise
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def prune_directory(directory, max_files, max_age=None):
+    """
+    Remove the oldest JSON files from a directory and its subdirectories.
+
+    :param directory: str
+        The directory of the cache.
+    :param max_files: int
+        The number of files that are kept, the most recently written ones.
+    :param max_age: float
+        The number of seconds a file is kept, or None to keep files of any age.
+    """
+    paths = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.endswith('.json'):
+                path = os.path.join(root, name)
+                try:
+                    paths.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+    paths.sort(reverse=True)
+    oldest = None if max_age is None else time.time() - max_age
+    for index, (modified, path) in enumerate(paths):
+        if index >= max_files or (oldest is not None and modified < oldest):
+            remove_file(path)
@@ -1,53 +1,55 @@
-from ics import Calendar, Event
 from dateutil import tz
 from datetime import datetime, timedelta
-from io import BytesIO
+from dataclasses import dataclass
+from functools import lru_cache
 
-#Konvertera datum och key i workind dictionary till en lista med ISO-datum.
-def convert_date_str(date_str):
-    try:
-        date_obj = datetime.strptime(date_str, "%d-%b")
-        date_obj = date_obj.replace(year=datetime.now().year)
-    except ValueError:
-        print(f"Unable to parse date string: {date_str}")
-        return None
+# Set your local timezone, e.g., for Sweden (CET/CEST)
+LOCAL_TZ = tz.gettz("Europe/Stockholm")
 
-    return date_obj
+# The characters that are left out of event UIDs
+UID_REMOVED_CHARACTERS = str.maketrans('', '', ':-+ ')
 
-def get_start_end_datetime(date_obj, start_time_str, end_time_str, add_one_day_to_end=False):
-    try:
-        start_time_obj = datetime.strptime(start_time_str, "%H:%M")
-        end_time_obj = datetime.strptime(end_time_str, "%H:%M")
 
-        start_datetime = date_obj.replace(hour=start_time_obj.hour, minute=start_time_obj.minute)
-        end_datetime = date_obj.replace(hour=end_time_obj.hour, minute=end_time_obj.minute)
+def parse_time(time_str):
+    # The time of day as an offset from midnight, 24:00 is the midnight at the end of the day
+    if time_str == "24:00":
+        return timedelta(days=1)
+    time_obj = datetime.strptime(time_str, "%H:%M")
+    return timedelta(hours=time_obj.hour, minutes=time_obj.minute)
 
-        if add_one_day_to_end:
-            end_datetime += timedelta(days=1)
-    except ValueError:
-        print(f"Unable to parse time range: {start_time_str}, {end_time_str}")
-        return None, None
 
-    return start_datetime, end_datetime
+@lru_cache(maxsize=1024)
+def parse_key_time_range(work_hours_key, time_range):
+    """
+    Parses one time range of a work key into offsets from the midnight of the shift's date.
+
+    The result only depends on the key and the time range, so it is cached and a month of shifts only
+    parses the handful of key definitions once.
 
-def handle_work_hours_key(work_hours_key, date_obj, time_range):
+    :param work_hours_key: str
+        The key of the shift, e.g. '12' or 'FM'.
+    :param time_range: str
+        The time range from working_hours_dict, e.g. '7:30 16:30'.
+
+    :return: tuple
+        (start offset, end offset, description), or None if the time range can not be parsed.
+    """
     try:
         if work_hours_key == "FM":
-            start_datetime, end_datetime = get_start_end_datetime(date_obj, *time_range.split(' '))
-            end_datetime += timedelta(days=1)
+            start_time_str, end_time_str = time_range.split(' ')
+            start, end = parse_time(start_time_str), parse_time(end_time_str) + timedelta(days=1)
             work_description = 'FM-dygn'
         elif work_hours_key in ["L", "0", "F", "S"]:
-            start_datetime, end_datetime = get_start_end_datetime(date_obj, '00:00', '23:59')
+            start, end = timedelta(0), timedelta(hours=23, minutes=59)
             work_description = 'Ledig' if work_hours_key =="F" else 'Föräldraledig' if work_hours_key =="S" else 'Semester'
         else:
             start_time_str, end_time_str = time_range.split(' ')
-            add_one_day_to_end = end_time_str == "24:00"
-            start_datetime, end_datetime = get_start_end_datetime(date_obj, start_time_str, end_time_str, add_one_day_to_end)
+            start, end = parse_time(start_time_str), parse_time(end_time_str)
             work_description = "Arbetspass"
     except ValueError:
         print(f"Unable to parse time range: {time_range}")
-        return None, None, None
-    return start_datetime, end_datetime, work_description
+        return None
+    return start, end, work_description
 
 
 def translate_month(date_str):
@@ -62,78 +64,155 @@ def translate_month(date_str):
 
     return date_str
 
-def convert_to_iso_dates(work_shifts, working_hours_dict):
-    start_end_dic = []
+@dataclass
+class Shift:
+    """One event in the calendar, with timezone aware start and end."""
+    __slots__ = ('start', 'end', 'description', 'key')
+    start: datetime
+    end: datetime
+    description: str
+    key: str
+
+
+@lru_cache(maxsize=512)
+def parse_day_month(date_str):
+    # The day and month of a date like '05-maj'. The year is not cached, so a server running over New Year
+    # does not keep the old one. A leap year is given to strptime so '29-feb' can be parsed.
+    date_obj = datetime.strptime(f"{translate_month(date_str)}-2000", "%d-%b-%Y")
+    return date_obj.day, date_obj.month
+
+
+def parse_shift_date(date_str, year=None):
+    # The midnight that starts the date in the given year, the current year by default, and the local timezone
+    day, month = parse_day_month(date_str)
+    return datetime(year or datetime.now().year, month, day, tzinfo=LOCAL_TZ)
+
+
+def build_shifts(work_shifts, working_hours_dict, year=None):
+    """
+    Converts the work shifts of a signature to Shift records, one per time range of the shift's key.
+
+    :param work_shifts: list
+        The {'date', 'work_hours'} dictionaries from pdf_processing or png_processing. A shift with 'hours'
+        uses those time ranges, e.g. when its key means other hours on its page than on other pages.
+    :param working_hours_dict: dict
+        The time ranges of every key.
+    :param year: int
+        The year of the shifts. Defaults to the current year.
+
+    :return: list
+        The Shift records in the order of the work shifts.
+    """
+    year = year or datetime.now().year
+    shifts = []
     for work_shift in work_shifts:
-        date_str = translate_month(work_shift['date'])  # translate month names
-        work_hours_key = work_shift['work_hours'] if work_shift['work_hours'].isdigit() else work_shift['work_hours']
-        date_obj = datetime.strptime(date_str, "%d-%b")
-        date_obj = date_obj.replace(year=datetime.now().year)
-        if work_hours_key in working_hours_dict:
-            time_ranges = working_hours_dict[work_hours_key]
-            for time_range in time_ranges:
-                start_datetime, end_datetime, work_description = handle_work_hours_key(work_hours_key, date_obj, time_range)
-                if start_datetime is None or end_datetime is None or work_description is None:
-                    print(f"Error handling work shift: {work_shift}")
-                    continue
-                start_end_dic.append({
-                    'start_datetime': start_datetime.isoformat(),
-                    'end_datetime': end_datetime.isoformat(),
-                    'work_description' : work_description})
-        else:
+        work_hours_key = work_shift['work_hours']
+        time_ranges = work_shift.get('hours', working_hours_dict.get(work_hours_key))
+        if time_ranges is None:
             print(f"work_hours_key {work_hours_key} not found in working_hours_dict.")
-    return start_end_dic
+            continue
+        date_obj = parse_shift_date(work_shift['date'], year)
+        for time_range in time_ranges:
+            parsed = parse_key_time_range(work_hours_key, time_range)
+            if parsed is None:
+                print(f"Error handling work shift: {work_shift}")
+                continue
+            start, end, work_description = parsed
+            shifts.append(Shift(date_obj + start, date_obj + end, work_description, work_hours_key))
+    return shifts
 
 
+def convert_to_iso_dates(work_shifts, working_hours_dict):
+    return [{'start_datetime': shift.start.replace(tzinfo=None).isoformat(),
+             'end_datetime': shift.end.replace(tzinfo=None).isoformat(),
+             'work_description': shift.description}
+            for shift in build_shifts(work_shifts, working_hours_dict)]
 
-def create_ics_file(start_end_dic):
-    # Create a calendar
-    cal = Calendar()
 
-    # Set your local timezone, e.g., for Sweden (CET/CEST)
-    local_tz = tz.gettz("Europe/Stockholm")
+PRODID = "-//PDF_to_ICS//Arbetspass//SV"
 
-    # Add events to the calendar for each work shift
-    for work_shift in start_end_dic:
-        event = Event()
-        #TODO Lägg till en rad som säger vilken omplan skiftet gäller i beskrivningen.
-        event.name = work_shift['work_description']  # Set the event name, e.g., "Arbetspass"
 
-        start_datetime = datetime.fromisoformat(work_shift['start_datetime']).replace(tzinfo=local_tz)
-        end_datetime = datetime.fromisoformat(work_shift['end_datetime']).replace(tzinfo=local_tz)
+def escape_text(value):
+    """Escapes a TEXT value according to RFC 5545 section 3.3.11."""
+    return (value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
 
-        # Add DTSTAMP
-        now = datetime.utcnow()
-        event.created = now
 
-        # Generate a unique identifier for the event
-        uid_data = f"{start_datetime.isoformat()}_{end_datetime.isoformat()}_{work_shift['work_description']}"
-        uid = uid_data.replace(":", "").replace("-", "").replace("+", "").replace(" ", "")
-        event.uid = uid
+def fold_line(line):
+    """
+    Folds a content line so that no line is longer than 75 octets, according to RFC 5545 section 3.1.
 
-        event.begin = start_datetime
-        event.end = end_datetime
+    :param line: str
+        The content line without the line break.
 
-        cal.events.add(event)
+    :return: str
+        The folded line ending with CRLF. Continuation lines start with a space.
+    """
+    if len(line.encode('utf-8')) <= 75:
+        return line + '\r\n'
 
-    #Gör en Bytes-IO-ström istället för en ICS-fil
-    ics_data = BytesIO()
-    ics_data.write(cal.serialize().encode('utf-8'))
-    ics_data.seek(0)
+    parts = []
+    current = ''
+    current_octets = 0
+    limit = 75
+    for char in line:
+        char_octets = len(char.encode('utf-8'))
+        # Never split a multi-byte character between two lines
+        if current_octets + char_octets > limit:
+            parts.append(current)
+            current = ''
+            current_octets = 0
+            limit = 74  # The leading space of a continuation line counts
+        current += char
+        current_octets += char_octets
+    parts.append(current)
+    return '\r\n '.join(parts) + '\r\n'
 
-    return ics_data
 
+def format_datetime(value):
+    """Formats a datetime as an RFC 5545 UTC date-time, e.g. 20240101T073000Z."""
+    return value.astimezone(tz.UTC).strftime('%Y%m%dT%H%M%SZ')
 
-def return_calendar(work_shifts, working_hours_dict):
-    main_calendar = Calendar()
 
-    start_end_dic = convert_to_iso_dates(work_shifts, working_hours_dict)
+def generate_ics(shifts):
+    """
+    Writes a calendar with the work shifts as RFC 5545 text, one folded content line at a time.
+
+    :param shifts: list
+        The Shift records from build_shifts.
+
+    :return: generator
+        The lines of the ICS file, each ending with CRLF. Flask can stream it as the response body.
+    """
+    yield fold_line('BEGIN:VCALENDAR')
+    yield fold_line('VERSION:2.0')
+    yield fold_line(f'PRODID:{PRODID}')
 
-    ics_data = create_ics_file(start_end_dic)
-    calendar = Calendar(ics_data.read().decode('utf-8'))
+    dtstamp = format_datetime(datetime.now(tz.UTC))
+    seen_uids = set()
 
-    for event in calendar.events:
-        main_calendar.events.add(event)
+    for shift in shifts:
+        #TODO Lägg till en rad som säger vilken omplan skiftet gäller i beskrivningen.
+        # Generate a unique identifier for the event from the local start, end and description
+        uid = (f"{shift.start:%Y%m%dT%H%M%S%z}_{shift.end:%Y%m%dT%H%M%S%z}_{shift.description}"
+               .translate(UID_REMOVED_CHARACTERS))
+
+        # The same shift read twice is only added once
+        if uid in seen_uids:
+            continue
+        seen_uids.add(uid)
+
+        yield fold_line('BEGIN:VEVENT')
+        yield fold_line(f'DTSTAMP:{dtstamp}')
+        yield fold_line(f'DTSTART:{format_datetime(shift.start)}')
+        yield fold_line(f'DTEND:{format_datetime(shift.end)}')
+        yield fold_line(f"SUMMARY:{escape_text(shift.description)}")
+        yield fold_line(f'UID:{escape_text(uid)}')
+        yield fold_line('END:VEVENT')
 
-    return main_calendar
+    yield fold_line('END:VCALENDAR')
 
+
+def return_calendar(work_shifts, working_hours_dict):
+    # Returns the ICS file as a string
+    return ''.join(generate_ics(build_shifts(work_shifts, working_hours_dict)))
@@ -0,0 +1,201 @@
+import threading
+
+import cv2
+import numpy as np
+
+# Components lower than this share of the crop height are not digits, e.g. the dots of a colon
+MIN_GLYPH_HEIGHT = 0.3
+# Components with at most this many pixels are specks of noise
+MAX_SPECK_AREA = 2
+# Shift keys have one or two digits, longer texts are left to Tesseract
+MAX_GLYPHS = 2
+# Glyphs are compared on a square canvas this many times the height of the first learned glyph
+CANVAS_SCALE = 1.6
+# A glyph is recognised when its best template is at least this similar (correlation of the ink, allowing a
+# shift of one pixel) and this much more similar than the best template of any other character
+MIN_SIMILARITY = 0.92
+MIN_MARGIN = 0.03
+# The height of a glyph may differ this much from the height of its template, since the font size is fixed
+MAX_HEIGHT_DIFFERENCE = 0.15
+# The number of templates kept per character
+MAX_TEMPLATES = 20
+# The number of characters that must have templates before crops are classified. With a single character
+# the margin to the second best one can not be measured, so every glyph close enough would be taken for it.
+MIN_CHARACTERS = 2
+
+
+def segment_glyphs(crop):
+    """
+    Cut a cell crop into the ink of its glyphs.
+
+    :param crop: numpy array
+        The grayscale cell crop without its frame, dark text on a lighter background.
+
+    :return: list
+        (ink, height) for every glyph from left to right, where ink is a float image from 0 for the background
+        of the cell to 1 for the darkest pixel. None if the crop does not look like one or two separate digits,
+        e.g. when ink touches the edge or when it holds a colon or a dash, which must be read by Tesseract.
+    """
+    if crop.size == 0 or min(crop.shape) < 4:
+        return None
+    # The ink is measured from the background of the cell, so shaded cells look like white ones
+    background, darkest = float(np.median(crop)), float(crop.min())
+    if background - darkest < 1:
+        return None
+    ink = np.clip((background - crop.astype(np.float32)) / (background - darkest), 0, 1)
+    _, labels, stats, _ = cv2.connectedComponentsWithStats((ink > 0.5).astype(np.uint8), connectivity=8)
+
+    glyphs = []
+    for label in range(1, len(stats)):
+        x, y, width, height, area = stats[label]
+        if area <= MAX_SPECK_AREA:
+            continue
+        if height < MIN_GLYPH_HEIGHT * crop.shape[0]:
+            return None
+        # Ink on the edge is a rest of the frame or a cut glyph, leave the crop to Tesseract
+        if x == 0 or y == 0 or x + width == crop.shape[1] or y + height == crop.shape[0]:
+            return None
+        glyphs.append((x, y, width, height))
+    if not glyphs or len(glyphs) > MAX_GLYPHS:
+        return None
+
+    # Keep the anti-aliased edge of every glyph
+    return [(ink[y - 1:y + height + 1, x - 1:x + width + 1], height) for x, y, width, height in sorted(glyphs)]
+
+
+def place_glyph(glyph_ink, size):
+    """
+    Place the ink of a glyph with its centre of mass in the middle of a square canvas.
+
+    :return: numpy array
+        The canvas, cut where the glyph is larger than it.
+    """
+    moments = cv2.moments(glyph_ink)
+    center_y, center_x = moments['m01'] / moments['m00'], moments['m10'] / moments['m00']
+    top, left = int(round(size / 2 - center_y)), int(round(size / 2 - center_x))
+    height, width = glyph_ink.shape
+    canvas = np.zeros((size, size), np.float32)
+    canvas[max(top, 0):min(top + height, size), max(left, 0):min(left + width, size)] = \
+        glyph_ink[max(-top, 0):min(size - top, height), max(-left, 0):min(size - left, width)]
+    return canvas
+
+
+def normalize(canvases):
+    # Rows with zero mean and unit length, so the dot product is the correlation
+    vectors = canvases.reshape(len(canvases), -1)
+    vectors = vectors - vectors.mean(axis=1, keepdims=True)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-6)
+
+
+class GlyphClassifier:
+    """
+    Recognises the digits of shift keys by comparing their glyphs with glyphs read by Tesseract.
+
+    A schedule uses the same font in every cell, so confident Tesseract reads of a document are templates
+    for the rest of it. Crops that are not close enough to the templates are left to Tesseract, and so is
+    every crop until templates of MIN_CHARACTERS characters have been learned.
+    """
+
+    def __init__(self, characters='0123456789'):
+        self.characters = characters
+        self.templates = {}
+        self.lock = threading.Lock()
+        # The size of the canvas, set by the first glyph that is learned
+        self.canvas_size = None
+        # The templates stacked for classify, rebuilt after new templates are added
+        self.matrix = None
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(templates) for templates in self.templates.values())
+
+    def add(self, crop, text):
+        """
+        Learn the glyphs of a crop that Tesseract read confidently.
+
+        :param crop: numpy array
+            The grayscale cell crop without its frame.
+        :param text: str
+            What Tesseract read, only used when it has one known character per glyph.
+
+        :return: bool
+            True if the glyphs were added as templates.
+        """
+        if not text or any(character not in self.characters for character in text):
+            return False
+        glyphs = segment_glyphs(crop)
+        if glyphs is None or len(glyphs) != len(text):
+            return False
+        with self.lock:
+            if self.canvas_size is None:
+                self.canvas_size = int(round(CANVAS_SCALE * max(height for _, height in glyphs)))
+            for character, (glyph_ink, height) in zip(text, glyphs):
+                templates = self.templates.setdefault(character, [])
+                if len(templates) < MAX_TEMPLATES:
+                    templates.append((place_glyph(glyph_ink, self.canvas_size), height))
+                    self.matrix = None
+        return True
+
+    def _get_matrix(self):
+        with self.lock:
+            if self.matrix is None and self.templates:
+                entries = [(character, canvas, height) for character, templates in self.templates.items()
+                           for canvas, height in templates]
+                # Every template is also stored moved by one pixel in each direction
+                shifted = np.array([np.roll(canvas, (shift_y, shift_x), axis=(0, 1)) for _, canvas, _ in entries
+                                    for shift_y in (-1, 0, 1) for shift_x in (-1, 0, 1)])
+                self.matrix = (normalize(shifted), self.canvas_size,
+                               np.array([self.characters.index(character) for character, _, _ in entries]),
+                               np.array([height for _, _, height in entries], np.float32))
+            return self.matrix
+
+    def classify(self, crops):
+        """
+        Recognise a batch of crops, comparing all of their glyphs with all templates at once.
+
+        :param crops: list
+            The grayscale cell crops without their frames.
+
+        :return: list
+            The text of every crop, or None where a glyph is not clearly like one character.
+        """
+        results = [None] * len(crops)
+        matrix = self._get_matrix()
+        if matrix is None:
+            return results
+        templates, canvas_size, template_characters, template_heights = matrix
+        if len(np.unique(template_characters)) < MIN_CHARACTERS:
+            return results
+
+        segmented = [(index, glyphs) for index, glyphs in enumerate(map(segment_glyphs, crops))
+                     if glyphs is not None]
+        if not segmented:
+            return results
+        glyphs = [glyph for _, crop_glyphs in segmented for glyph in crop_glyphs]
+        vectors = normalize(np.array([place_glyph(glyph_ink, canvas_size) for glyph_ink, _ in glyphs]))
+        heights = np.array([height for _, height in glyphs], np.float32)
+
+        # Best similarity per glyph and template over the shifts, then per character.
+        # Characters without templates never win.
+        similarities = (vectors @ templates.T).reshape(len(vectors), len(template_characters), -1).max(axis=2)
+        per_character = np.full((len(vectors), len(self.characters)), -1.0, np.float32)
+        for character in np.unique(template_characters):
+            per_character[:, character] = similarities[:, template_characters == character].max(axis=1)
+        ranked = np.sort(per_character, axis=1)
+        best_characters = per_character.argmax(axis=1)
+
+        # The height of the best matching template of the winning character
+        best_templates = np.where(template_characters[None, :] == best_characters[:, None], similarities,
+                                  -np.inf).argmax(axis=1)
+        height_difference = np.abs(heights - template_heights[best_templates]) / template_heights[best_templates]
+
+        recognised = (ranked[:, -1] >= MIN_SIMILARITY) & (ranked[:, -1] - ranked[:, -2] >= MIN_MARGIN) & \
+                     (height_difference <= MAX_HEIGHT_DIFFERENCE)
+
+        start = 0
+        for index, crop_glyphs in segmented:
+            end = start + len(crop_glyphs)
+            if recognised[start:end].all():
+                results[index] = ''.join(self.characters[character] for character in best_characters[start:end])
+            start = end
+        return results
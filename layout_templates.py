@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from cache_store import LruDict, write_json
+
+
+# The number of layouts kept per PDF fingerprint, e.g. for pages of one format with their rows in other places
+MAX_LAYOUTS_PER_FINGERPRINT = 4
+
+
+def count_positions(positions, tolerance=1):
+    # The number of distinct positions, counting positions within tolerance of each other once
+    positions = sorted(positions)
+    return sum(1 for previous, position in zip([None] + positions, positions)
+               if previous is None or position - previous > tolerance)
+
+
+def pdf_page_fingerprint(page):
+    """
+    Fingerprint a PDF page by the structure of its table grid.
+
+    The features are the page size, the bounding box of the ruling lines rounded to 5 points, the number of
+    rows and columns of ruling lines, and the letters of the heading above them. Schedules of the same format
+    for other weeks share a fingerprint even when their lines are not in exactly the same places, so
+    LayoutStore.find_pdf_layout checks the stored lines with lines_present before a layout is used.
+
+    :param page: pdfplumber Page
+        The page to fingerprint.
+
+    :return: str
+        The SHA-256 hex digest of the features.
+    """
+    edges = page.edges
+    features = [round(page.width), round(page.height)]
+    if edges:
+        top = min(edge['top'] for edge in edges)
+        bbox = [min(edge['x0'] for edge in edges), top, max(edge['x1'] for edge in edges),
+                max(edge['bottom'] for edge in edges)]
+        # The week numbers and dates of the heading change with every schedule, its letters do not
+        heading = ''.join(char['text'] for char in page.chars if char['bottom'] <= top and char['text'].isalpha())
+        features += [[round(value / 5) for value in bbox],
+                     count_positions([edge['top'] for edge in edges if edge['orientation'] == 'h']),
+                     count_positions([edge['x0'] for edge in edges if edge['orientation'] == 'v']),
+                     heading]
+    return hashlib.sha256(json.dumps(features).encode('utf-8')).hexdigest()
+
+
+def draw_pdf_edges(page, margin=1):
+    """
+    Draw the ruling lines of a PDF page in a binary image with one pixel per point.
+
+    :param margin: int
+        The number of pixels the lines are widened by on every side. The cells found by the table finder
+        can be up to half a point away from the lines they were built from.
+
+    :return: numpy array
+        The binary image, with the lines white.
+    """
+    height, width = int(np.ceil(page.height)) + 1, int(np.ceil(page.width)) + 1
+    image = np.zeros((height, width), np.uint8)
+    for edge in page.edges:
+        image[max(int(edge['top']) - margin, 0):max(int(edge['bottom']) + margin + 1, 0),
+              max(int(edge['x0']) - margin, 0):max(int(edge['x1']) + margin + 1, 0)] = 255
+    return image
+
+
+def pdf_layout_present(page, layout):
+    """
+    Check that the borders of the cells of a stored PDF layout are ruling lines on a page.
+
+    :param page: pdfplumber Page
+        The page.
+    :param layout: list
+        The cells of every table as [x0, top, x1, bottom] lists, like LayoutStore stores them.
+
+    :return: boolean
+        True if every cell border is found on the page.
+    """
+    horizontal, vertical = set(), set()
+    for cells in layout:
+        for x0, top, x1, bottom in cells:
+            x0, top, x1, bottom = int(x0), int(top), int(x1), int(bottom)
+            horizontal.update([(top, 1, x0, x1), (bottom, 1, x0, x1)])
+            vertical.update([(x0, 1, top, bottom), (x1, 1, top, bottom)])
+    image = draw_pdf_edges(page)
+    return lines_present(image, horizontal, True) and lines_present(image, vertical, False)
+
+
+def png_layout_key(layout):
+    # The SHA-256 hex digest of a screenshot layout, so the same layout is stored once
+    return hashlib.sha256(json.dumps(layout, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def lines_present(binary_image, lines, is_horizontal, min_white=0.9):
+    """
+    Check that grid lines stored in a layout are present in a binary image.
+
+    :param binary_image: numpy array
+        The binary image, with the grid lines white.
+    :param lines: list
+        The lines as [fixed, thickness, start, end] lists.
+    :param is_horizontal: bool
+        Whether the lines are horizontal.
+    :param min_white: float
+        The share of a line's pixels that must be white.
+
+    :return: boolean
+        True if every line is found in the image.
+    """
+    for fixed, thickness, start, end in lines:
+        if is_horizontal:
+            pixels = binary_image[fixed:fixed + thickness, start:end]
+        else:
+            pixels = binary_image[start:end, fixed:fixed + thickness]
+        if pixels.size == 0 or np.count_nonzero(pixels == 255) < min_white * pixels.size:
+            return False
+    return True
+
+
+class LayoutStore:
+    """
+    The geometry of schedule layouts that have been seen before.
+
+    PDF pages are recognised by pdf_page_fingerprint and by the stored cell borders being ruling lines on
+    the page, and store the cells of every table on the page, so the tables can be rebuilt without
+    pdfplumber's table finder. PNG screenshots are recognised by their size and by the stored grid lines
+    being present in the image, and store the merged grid lines, so line detection can be skipped.
+    png_processing also checks that the image has no lines the stored layout lacks.
+
+    With a path the layouts are also kept in a JSON file, so they survive restarts. At most max_layouts
+    PDF fingerprints, with up to MAX_LAYOUTS_PER_FINGERPRINT layouts each, and max_layouts PNG layouts are
+    kept, and the least recently used one is dropped first.
+    """
+
+    def __init__(self, path=None, max_layouts=100):
+        self.path = path
+        self.max_layouts = max_layouts
+        self.lock = threading.Lock()
+        # PDF layouts are lists of layouts keyed by the page fingerprint, the most recently used one last.
+        # PNG layouts are keyed by the layout itself.
+        self.pdf_layouts = LruDict(max_layouts)
+        self.png_layouts = LruDict(max_layouts)
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as file:
+                    data = json.load(file)
+                # Layouts stored under 'pdf' were fingerprinted by their exact lines and are not read
+                self.pdf_layouts = LruDict(max_layouts, data.get('pdf_fingerprints', {}).items())
+                self.png_layouts = LruDict(max_layouts, [(png_layout_key(layout), layout)
+                                                         for layout in data.get('png', [])])
+            except (OSError, ValueError) as e:
+                print(f"Could not read layout templates from {path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {'pdf_fingerprints': dict(self.pdf_layouts.items()),
+                    'png': [layout for _, layout in self.png_layouts.items()]}
+        try:
+            write_json(self.path, data)
+        except OSError as e:
+            print(f"Could not save layout templates to {self.path}: {e}")
+
+    def find_pdf_layout(self, page):
+        """Get the cells of every table of a known page layout, or None"""
+        fingerprint = pdf_page_fingerprint(page)
+        with self.lock:
+            layouts = list(self.pdf_layouts.get(fingerprint, []))
+        # Pages of the same format can have their lines in other places, so the lines are checked
+        for layout in reversed(layouts):
+            if pdf_layout_present(page, layout):
+                self._use_pdf_layout(fingerprint, layout)
+                return layout
+        return None
+
+    def _use_pdf_layout(self, fingerprint, layout):
+        # Make a layout the most recently used one of its fingerprint. Returns False if it is not stored.
+        with self.lock:
+            layouts = self.pdf_layouts.get(fingerprint, [])
+            if layout not in layouts:
+                return False
+            self.pdf_layouts.set(fingerprint, [other for other in layouts if other != layout] + [layout])
+            return True
+
+    def learn_pdf_layout(self, page, tables):
+        """Store the cells of the tables that pdfplumber found on a page"""
+        layout = [[list(cell) for cell in table.cells] for table in tables]
+        fingerprint = pdf_page_fingerprint(page)
+        if self._use_pdf_layout(fingerprint, layout):
+            return
+        with self.lock:
+            layouts = self.pdf_layouts.get(fingerprint, []) + [layout]
+            self.pdf_layouts.set(fingerprint, layouts[-MAX_LAYOUTS_PER_FINGERPRINT:])
+        self.save()
+
+    def find_png_layout(self, binary_image):
+        """Get the horizontal and vertical lines of a known screenshot layout, or None"""
+        with self.lock:
+            layouts = self.png_layouts.items()
+        # The most recently used layouts are tried first
+        for key, layout in reversed(layouts):
+            if tuple(layout['shape']) == binary_image.shape[:2] and \
+                    lines_present(binary_image, layout['horizontal'], True) and \
+                    lines_present(binary_image, layout['vertical'], False):
+                with self.lock:
+                    self.png_layouts.get(key)
+                return layout['horizontal'], layout['vertical']
+        return None
+
+    def learn_png_layout(self, binary_image, horizontal_lines, vertical_lines):
+        """Store the merged grid lines found in a screenshot"""
+        layout = {'shape': list(binary_image.shape[:2]),
+                  'horizontal': [list(line) for line in horizontal_lines],
+                  'vertical': [list(line) for line in vertical_lines]}
+        key = png_layout_key(layout)
+        with self.lock:
+            # The same layout is stored once, e.g. when a page with extra lines made detection run again
+            if self.png_layouts.get(key) is not None:
+                return
+            self.png_layouts.set(key, layout)
+        self.save()
+
+
+# The store used by pdf_processing and png_processing. Set LAYOUT_TEMPLATES_PATH to keep it on disk.
+layout_store = LayoutStore(os.environ.get('LAYOUT_TEMPLATES_PATH'),
+                           max_layouts=int(os.environ.get('LAYOUT_TEMPLATES_SIZE', 100)))
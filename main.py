@@ -1,15 +1,81 @@
-from flask import Flask, render_template, request, send_file, flash, url_for, redirect
-from cal_functions import return_calendar
-import tempfile
+from flask import Flask, Request, Response, render_template, request, send_file, flash, url_for, redirect, jsonify
+from cal_functions import return_calendar, convert_to_iso_dates, build_shifts, generate_ics as generate_ics_lines
 import os
+import zipfile
+from urllib.parse import quote
 from io import BytesIO
 import traceback
-import png_processing
-import pdf_processing
+from schedule_jobs import PARSERS, parse_schedule, job_queue
+import metrics
+import time
+
+
+class InMemoryRequest(Request):
+    # Keep uploaded files in memory instead of spooling them to a temporary file.
+    # Their size is capped by MAX_CONTENT_LENGTH, larger requests get 413 Request Entity Too Large.
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return BytesIO()
+
+
+def attachment_header(filename):
+    # Content-Disposition for a download, signatures like BÖK need the RFC 5987 form
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*=UTF-8''{quote(filename)}"
+
+
+def read_upload(upload_file):
+    # The uploaded file as a BytesIO, without copying it when it is already in memory
+    if isinstance(upload_file.stream, BytesIO):
+        upload_file.stream.seek(0)
+        upload = upload_file.stream
+    else:
+        upload = BytesIO(upload_file.read())
+    UPLOAD_BYTES.observe(upload.getbuffer().nbytes, type=os.path.splitext(upload_file.filename)[1].lower().lstrip('.'))
+    return upload
 
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
 app.secret_key = 'your_secret_key'  # replace with your own secret key
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_SIZE', 20 * 1024 * 1024))
+
+REQUEST_SECONDS = metrics.histogram('request_seconds', 'Seconds spent handling a request by endpoint and status.')
+UPLOAD_BYTES = metrics.histogram('upload_bytes', 'Size of an uploaded schedule by file type.', metrics.SIZE_BUCKETS)
+ICS_BYTES = metrics.histogram('ics_bytes', 'Size of a generated ICS file.', metrics.SIZE_BUCKETS)
+STAGE_SECONDS = metrics.histogram('stage_seconds', 'Seconds spent in a pipeline stage.')
+
+
+@app.before_request
+def start_timer():
+    request.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if hasattr(request, 'start_time'):
+        start_time, endpoint, status = request.start_time, request.endpoint or 'unknown', response.status_code
+
+        def observe():
+            REQUEST_SECONDS.observe(time.perf_counter() - start_time, endpoint=endpoint, status=status)
+
+        # A streamed response is still being written here, so it is timed when it has been sent
+        if response.is_streamed:
+            response.call_on_close(observe)
+        else:
+            observe()
+    return response
+
+
+def count_ics_bytes(lines):
+    # Pass the streamed ICS lines through and record the size of the file when it is done
+    size = 0
+    for line in lines:
+        size += len(line.encode('utf-8'))
+        yield line
+    ICS_BYTES.observe(size)
 
 
 @app.route('/')
@@ -25,35 +91,33 @@ def generate_ics():
 
     if upload_file and sign:
         file_extension = os.path.splitext(upload_file.filename)[1].lower()
-        temp_file_fd, temp_file_path = tempfile.mkstemp(suffix=file_extension)
-        with os.fdopen(temp_file_fd, 'wb') as tmp:
-            # write the data to file
-            tmp.write(upload_file.read())
+        if file_extension not in PARSERS:
+            flash("Invalid file type. Please upload a PDF or PNG file.")
+            return redirect(url_for('index'))
 
-        try:
-            if file_extension == '.pdf':
-                work_shifts, working_hours_dict = pdf_processing.return_work_shifts_and_working_keys(sign, temp_file_path)
-            elif file_extension == '.png':
+        # In async mode the parse runs in a worker process and the client polls the job
+        if request.form.get('async', '').lower() in ('1', 'true', 'on'):
+            job_id = job_queue.submit(read_upload(upload_file), file_extension, sign)
+            if job_id is None:
+                return jsonify({'error': "Too many jobs are waiting, try again later"}), 503
+            return jsonify({'job_id': job_id, 'status_url': url_for('job_status', job_id=job_id),
+                            'download_url': url_for('job_download', job_id=job_id)}), 202
 
-                work_shifts, working_hours_dict = png_processing.return_work_shifts_and_working_keys(sign, temp_file_path)
+        try:
+            work_shifts, working_hours_dict = parse_schedule(read_upload(upload_file), file_extension, [sign])[sign]
+            if file_extension == '.png':
                 print(f'Work shifts: {work_shifts}')
                 print(f'Working hours dict: {working_hours_dict}')
-            else:
-                flash("Invalid file type. Please upload a PDF or PNG file.")
-                return redirect(url_for('index'))
+            with STAGE_SECONDS.time(stage='build_shifts'):
+                shifts = build_shifts(work_shifts, working_hours_dict)
         except Exception as e:
             error_info = traceback.format_exc()
             flash(error_info)
             return redirect(url_for('index'))
-        finally:
-            os.remove(temp_file_path)  # Make sure to delete the file in any case
 
-        main_calendar = return_calendar(work_shifts, working_hours_dict) #Returns an ICS-file
-        print(f'main calendar: {main_calendar}')
-        if main_calendar:
-            ics_data = BytesIO(main_calendar.serialize().encode('utf-8'))
-
-        return send_file(ics_data, as_attachment=True, attachment_filename=f"arbetspass_{sign}.ics", mimetype='text/calendar')
+        # Stream the ICS file to the client while it is written
+        return Response(count_ics_bytes(generate_ics_lines(shifts)), mimetype='text/calendar',
+                        headers={'Content-Disposition': attachment_header(f"arbetspass_{sign}.ics")})
 
 
     else:
@@ -61,6 +125,82 @@ def generate_ics():
         return redirect(url_for('index'))
 
 
+@app.route('/generate_ics_batch', methods=['POST'])
+def generate_ics_batch():
+    # Parses the schedule once and returns the shifts of several signatures.
+    # 'names' is a comma separated list of signatures, empty for every signature in the schedule.
+    # 'format' is 'zip' for one ICS file per signature or 'json' for the shifts of every signature.
+    upload_file = request.files.get('upload_file')
+    names = request.form.get('names', '')
+    output_format = request.form.get('format', 'zip')
+    signs = [name.strip() for name in names.split(',') if name.strip()] or None
+
+    if not upload_file or output_format not in ('zip', 'json'):
+        flash("Något gick fel. Försök igen.")
+        return redirect(url_for('index'))
+
+    file_extension = os.path.splitext(upload_file.filename)[1].lower()
+    if file_extension not in PARSERS:
+        flash("Invalid file type. Please upload a PDF or PNG file.")
+        return redirect(url_for('index'))
+
+    try:
+        results = parse_schedule(read_upload(upload_file), file_extension, signs)
+    except Exception as e:
+        error_info = traceback.format_exc()
+        flash(error_info)
+        return redirect(url_for('index'))
+
+    if output_format == 'json':
+        return jsonify({sign: convert_to_iso_dates(work_shifts, working_hours_dict)
+                        for sign, (work_shifts, working_hours_dict) in results.items()})
+
+    zip_data = BytesIO()
+    with zipfile.ZipFile(zip_data, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for sign, (work_shifts, working_hours_dict) in results.items():
+            ics = return_calendar(work_shifts, working_hours_dict)
+            ICS_BYTES.observe(len(ics.encode('utf-8')))
+            zip_file.writestr(f"arbetspass_{sign}.ics", ics)
+    zip_data.seek(0)
+
+    return send_file(zip_data, as_attachment=True, attachment_filename="arbetspass.zip", mimetype='application/zip')
+
+
+@app.route('/jobs', methods=['GET'])
+def job_stats():
+    # Queue depth and latency of the async jobs
+    return jsonify(job_queue.stats())
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    status = job_queue.status(job_id)
+    if status is None:
+        return jsonify({'error': f"No job with id {job_id}"}), 404
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def job_download(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f"No job with id {job_id}"}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': job['error']}), 500
+    if job['status'] != 'done':
+        return jsonify({'status': job['status']}), 409
+
+    ics_data = BytesIO(job['ics'].encode('utf-8'))
+    ICS_BYTES.observe(ics_data.getbuffer().nbytes)
+    return send_file(ics_data, as_attachment=True, attachment_filename=f"arbetspass_{job['sign']}.ics",
+                     mimetype='text/calendar')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # The counters and histograms of this process in the Prometheus text format
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,145 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Every metric name gets this prefix
+PREFIX = 'pdf_to_ics_'
+
+# Buckets for durations in seconds and for sizes and counts
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A value that only goes up, e.g. the number of Tesseract calls, per combination of labels."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+    """Observed values, e.g. latencies, counted in cumulative buckets per combination of labels."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=SECONDS_BUCKETS):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in a with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((self.name + '_bucket', key + (('le', format_value(bound)),), count))
+                samples.append((self.name + '_sum', key, total))
+                samples.append((self.name + '_count', key, counts[-1]))
+        return samples
+
+
+class Gauge:
+    """A value read when the metrics are rendered, e.g. the depth of the job queue."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, function):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        return [(self.name, (), self.function())]
+
+
+class Registry:
+    """The metrics of this process, rendered in the Prometheus text format by render()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, documentation, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, documentation, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation):
+        return self._get_or_create(Counter, name, documentation)
+
+    def histogram(self, name, documentation, buckets=SECONDS_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, buckets=buckets)
+
+    def gauge(self, name, documentation, function):
+        return self._get_or_create(Gauge, name, documentation, function=function)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+gauge = registry.gauge
+render = registry.render
+
+# The content type of the Prometheus text format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
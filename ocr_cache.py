@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+
+from cache_store import LruDict, write_json, prune_directory
+
+# Returned by OcrCache.get when a key is not cached, since None is a valid cached result
+MISS = object()
+
+# Part of every key. Raise it when the format of the cached results changes, so results written by an
+# older version in OCR_CACHE_DIR are not read back in the wrong format.
+CACHE_FORMAT_VERSION = 2
+
+
+def make_key(image, config, step=None, backend=None):
+    """
+    Build the cache key of an OCR call from the image pixels and the OCR settings.
+
+    :param image: numpy array
+        The image that is sent to Tesseract.
+    :param config: str
+        The Tesseract config, e.g. '--psm 7'.
+    :param step: str
+        The name of the read_cell step that made the image, e.g. 'rescaled' or 'dilated'.
+    :param backend: str
+        The name of the OCR backend, e.g. 'tesserocr', since backends can read the same pixels differently.
+
+    :return: str
+        The SHA-256 hex digest of the cache format version, the pixels, the image shape and the settings.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_FORMAT_VERSION}|{image.shape}|{image.dtype}|{config}|{step}|{backend}".encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class OcrCache:
+    """
+    OCR results keyed by the hash of the cell image and the OCR config.
+
+    The in-memory tier holds at most max_entries results and evicts the least recently used one.
+    With a directory the results are also stored on disk, one JSON file per key, so that worker
+    processes can share them. The directory holds at most about max_disk_entries results, the least
+    recently used ones are removed when it has grown by a tenth of that.
+    """
+
+    def __init__(self, max_entries=10000, directory=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        # The results written since the directory was pruned
+        self.disk_writes = 0
+        self.entries = LruDict(max_entries)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                return self.entries.get(key)
+
+        if self.directory:
+            try:
+                with open(self._path(key), encoding='utf-8') as file:
+                    value = json.load(file)
+            except (OSError, ValueError):
+                pass
+            else:
+                # Reading a result marks it as used, so it is pruned after the ones that are not read
+                try:
+                    os.utime(self._path(key))
+                except OSError:
+                    pass
+                with self.lock:
+                    self.entries.set(key, value)
+                    self.disk_hits += 1
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return MISS
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.set(key, value)
+
+        if self.directory:
+            path = self._path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_json(path, value)
+            except OSError:
+                return
+            with self.lock:
+                self.disk_writes += 1
+                prune = self.disk_writes >= max(self.max_disk_entries // 10, 1)
+                if prune:
+                    self.disk_writes = 0
+            # Listing the directory is slow, so it is only pruned now and then
+            if prune:
+                prune_directory(self.directory, self.max_disk_entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses}
+
+
+# The cache used by png_processing. Set OCR_CACHE_DIR to share results between worker processes.
+ocr_cache = OcrCache(max_entries=int(os.environ.get('OCR_CACHE_SIZE', 10000)),
+                     directory=os.environ.get('OCR_CACHE_DIR'),
+                     max_disk_entries=int(os.environ.get('OCR_CACHE_DISK_SIZE', 100000)))
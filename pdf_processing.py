@@ -1,30 +1,160 @@
 import pdfplumber
-import tempfile
+from pdfplumber.table import Table
 import re
+from layout_templates import layout_store
+import metrics
 
-def import_pdf(pdf_file_path):
-    # Save the file temporarily
-    temp_pdf_file = tempfile.NamedTemporaryFile(delete=False)
-    temp_pdf_file.write(pdf_file_path.read())
-    temp_pdf_file.close()
-    return temp_pdf_file
+PDF_PAGES = metrics.histogram('pdf_pages', 'Pages in an uploaded PDF.', metrics.SIZE_BUCKETS)
+EXTRACT_TABLES_SECONDS = metrics.histogram('pdf_extract_tables_seconds',
+                                           'Seconds spent extracting the tables of one PDF page.')
 
-def get_amount_of_pages(pdf_file_path):
-    with pdfplumber.open(pdf_file_path) as pdf:
-        total_pages = len(pdf.pages)
 
-    return total_pages
+def locate_schedule_regions(page, sign, words=None):
+    """
+    Find the parts of a page that hold the signature's rows and the key legend, using only the words on the page.
 
+    :param page: pdfplumber Page
+        The page to search.
+    :param sign: str
+        The signature to look for.
+    :param words: list
+        The words of the page from extract_words, read from the page if not given.
 
-def get_tables_from_pdf(x, pdf_file_path):
-    #Ändra så att den läser filen som skickades via formulär istället enligt gpt
-    # Läser av tabellerna i en PDF och skapar Listor av listor av dem
-    with pdfplumber.open(pdf_file_path) as pdf:
-        first_page = pdf.pages[x]
-        tables = first_page.extract_tables()
+    :return: list
+        The (x0, top, x1, bottom) bounding boxes of the schedule grid from the date row down to the
+        signature's row, and of the key legend. None if the page holds no signature row below a date row.
+    """
+    if words is None:
+        words = page.extract_words()
+    date_words = [word for word in words if is_date_format(word['text'])]
+    if not date_words:
+        return None
+    date_top = min(word['top'] for word in date_words)
+
+    sign_words = [word for word in words if word['text'] == sign and word['top'] > date_top]
+    if not sign_words:
+        return None
+    sign_bottom = min(sign_words, key=lambda word: word['top'])['bottom']
+
+    # Extend every region to the text of the neighbouring rows, so the table borders are inside it
+    def text_above(top):
+        return max((word['bottom'] for word in words if word['bottom'] < top), default=0)
+
+    def text_below(bottom):
+        return min((word['top'] for word in words if word['top'] > bottom), default=page.height)
+
+    regions = [(0, text_above(date_top), page.width, text_below(sign_bottom))]
+    regions.append(locate_legend_region(page, words, sign_bottom) or
+                   (0, text_above(sign_bottom), page.width, page.height))
+    return regions
+
+
+def locate_legend_region(page, words=None, below=0):
+    """
+    Find the part of a page that holds the key legend, using only the words on the page.
+
+    :param page: pdfplumber Page
+        The page to search.
+    :param words: list
+        The words of the page from extract_words, read from the page if not given.
+    :param below: float
+        The legend is only looked for below this y coordinate.
+
+    :return: tuple
+        The (x0, top, x1, bottom) bounding box from the legend down to the end of the page, or None if the
+        page holds no legend below the given coordinate.
+    """
+    if words is None:
+        words = page.extract_words()
+
+    # The legend starts at the key 1 that has a time to its right and the key 2 right below it
+    times = [word for word in words if re.fullmatch(r'\d{1,2}:\d{2}', word['text'])]
+    twos = [word for word in words if word['text'] == '2']
+    legend_tops = [word['top'] for word in words if word['text'] == '1' and word['top'] > below and
+                   any(abs(time['top'] - word['top']) < 2 and time['x0'] > word['x1'] for time in times) and
+                   any(abs(two['x0'] - word['x0']) < 2 and 0 < two['top'] - word['top'] < 20 for two in twos)]
+    if not legend_tops:
+        return None
+    legend_top = min(legend_tops)
+    # Extend the region to the text above, so the table border is inside it
+    top = max((word['bottom'] for word in words if word['bottom'] < legend_top), default=0)
+    return 0, top, page.width, page.height
+
+
+# Whether pages are matched against learned layouts, so tables can be rebuilt without the table finder
+USE_LAYOUT_TEMPLATES = True
+
+
+def find_page_tables(page):
+    # Find the tables on the whole page, and remember the layout for the next upload
+    if not USE_LAYOUT_TEMPLATES:
+        return page.extract_tables()
+    found_tables = page.find_tables()
+    layout_store.learn_pdf_layout(page, found_tables)
+    return [table.extract() for table in found_tables]
+
+
+def extract_page_tables(page, sign=None, regions=None):
+    # A page with a known layout gets its tables rebuilt from the stored cells
+    if USE_LAYOUT_TEMPLATES:
+        layout = layout_store.find_pdf_layout(page)
+        if layout is not None:
+            if regions is not None:
+                # Only rebuild the rows inside the regions, like the cropped extraction below
+                layout = [[cell for cell in cells
+                           if any(top <= (cell[1] + cell[3]) / 2 <= bottom for _, top, _, bottom in regions)]
+                          for cells in layout]
+            tables = [Table(page, cells).extract() for cells in layout if cells]
+            date_list, name_list = extract_date_and_name_lists(tables, sign)
+            if sign is None or (date_list and name_list):
+                return tables
+
+    if regions is None:
+        return find_page_tables(page)
+
+    # Only extract tables from the regions that matter
+    tables = [table for region in regions for table in page.crop(region).extract_tables()]
+
+    # Cropping can cut a table in a way the table finder does not handle, then read the whole page
+    date_list, name_list = extract_date_and_name_lists(tables, sign)
+    if not date_list or not name_list:
+        tables = find_page_tables(page)
     return tables
 
 
+def iter_page_tables(pdf_file_path, sign=None):
+    # Öppnar PDF:en en gång och läser av tabellerna sida för sida.
+    # pdf_file_path can also be a file object, e.g. a BytesIO with the upload, which is read from the start.
+    if hasattr(pdf_file_path, 'seek'):
+        pdf_file_path.seek(0)
+    with pdfplumber.open(pdf_file_path) as pdf:
+        PDF_PAGES.observe(len(pdf.pages))
+        for page in pdf.pages:
+            regions = None
+            if sign is not None:
+                words = page.extract_words()
+                regions = locate_schedule_regions(page, sign, words)
+                if regions is None:
+                    # A page without the signature is skipped, except for its key legend, which can define
+                    # keys that the signature's pages use
+                    legend_region = locate_legend_region(page, words)
+                    if legend_region is None:
+                        page.flush_cache()
+                        continue
+                    with EXTRACT_TABLES_SECONDS.time():
+                        tables = page.crop(legend_region).extract_tables()
+                    page.flush_cache()
+                    yield tables
+                    continue
+
+            with EXTRACT_TABLES_SECONDS.time():
+                tables = extract_page_tables(page, sign, regions)
+
+            # Release the parsed objects of the page before moving on to the next one
+            page.flush_cache()
+            yield tables
+
+
 def is_date_format(cell):
     if cell is None:
         return False
@@ -51,6 +181,26 @@ def extract_date_and_name_lists(tables, name):
     return date_list, name_list
 
 
+def extract_date_and_name_rows(tables, signs=None):
+    date_list = None
+    name_rows = {}
+
+    # Tar ut datumraden och raderna för alla signaturer i samma tabell
+    for table in tables:
+        for index, row in enumerate(table):
+            if row and len(row) > 0:
+                date_like_cells = [cell for cell in row if is_date_format(cell)]
+                if len(date_like_cells) / len(row) > 0.5:
+                    date_list = [date.replace("maj", "may").replace("okt", "oct") for date in row]
+                    # Every row below the date row that starts with a signature belongs to a person.
+                    # Given signatures are matched exactly, like in extract_date_and_name_lists.
+                    name_rows = {name_row[0]: name_row for name_row in table[index + 1:]
+                                 if name_row and len(name_row) == len(row) and name_row[0] and
+                                 (name_row[0] in signs if signs is not None else
+                                  re.fullmatch(r'[A-ZÅÄÖ]{2,4}', name_row[0]))}
+    return date_list, name_rows
+
+
 def create_work_shifts(date_list, name_list):
     work_shifts = []
 
@@ -113,20 +263,114 @@ def remove_last_and_empty(input_list):
     return [item for index, item in enumerate(input_list[:-1]) if item]
 
 
+def get_working_hours_dict(tables):
+    working_hours_list = extract_working_hours_list(tables)
+    working_hours_dict = create_working_hours_dict(working_hours_list)
+    for key in working_hours_dict:
+        if key == 'FM':
+            continue
+        else:
+            working_hours_dict[key] = remove_last_and_empty(working_hours_dict[key])
+    return working_hours_dict
+
+
+def new_shift_collection():
+    return {'work_shifts': [], 'working_hours_dict': {}, 'seen_dates': set()}
+
+
+def keys_with_times(page_hours):
+    # A key can be in the legend of a page without its times, e.g. FM, then the hours of other pages are used.
+    # Days off are whole days and have no times.
+    return {key: hours for key, hours in page_hours.items()
+            if key in ["L", "0", "F", "S"] or any(re.search(r'\d{1,2}:\d{2}', time_range) for time_range in hours)}
+
+
+def add_legend_hours(collection, legend_hours):
+    # Keys from the legend of a page without the signature's row are only used when no page with it defines them
+    for key, hours in keys_with_times(legend_hours).items():
+        collection['working_hours_dict'].setdefault(key, hours)
+
+
+def add_page_shifts(collection, date_list, name_list, page_hours):
+    # Add the shifts of this page to the ones found on earlier pages
+    page_shifts = [work_shift for work_shift in create_work_shifts(date_list, name_list)
+                   if work_shift['date'] not in collection['seen_dates']]
+    collection['seen_dates'].update(work_shift['date'] for work_shift in page_shifts)
+
+    page_hours = keys_with_times(page_hours)
+
+    # The legend can differ between pages, so every shift keeps the hours of its key on its own page.
+    # build_shifts uses them before the hours in working_hours_dict.
+    for work_shift in page_shifts:
+        if work_shift['work_hours'] in page_hours:
+            work_shift['hours'] = page_hours[work_shift['work_hours']]
+    collection['work_shifts'].extend(page_shifts)
+
+    page_keys = {work_shift['work_hours'] for work_shift in page_shifts}
+    for key, hours in page_hours.items():
+        if key in page_keys or key not in collection['working_hours_dict']:
+            collection['working_hours_dict'][key] = hours
+
+
 def return_work_shifts_and_working_keys(sign, _temp_pdf_file_path):
-    temp_pdf_file_path = _temp_pdf_file_path
-    number_of_pages = get_amount_of_pages(temp_pdf_file_path)
-    x = 0
-    while x < number_of_pages:
-        tables = get_tables_from_pdf(x, temp_pdf_file_path)
+    collection = new_shift_collection()
+    sign_found = False
+    legend_hours = []
+
+    for tables in iter_page_tables(_temp_pdf_file_path, sign):
         date_list, name_list = extract_date_and_name_lists(tables, sign)
-        work_shifts = create_work_shifts(date_list, name_list)
-        working_hours_list = extract_working_hours_list(tables)
-        working_hours_dict = create_working_hours_dict(working_hours_list)
-        for key in working_hours_dict:
-            if key == 'FM':
-                continue
-            else:
-                working_hours_dict[key] = remove_last_and_empty(working_hours_dict[key])
-        x = x + 1
-    return work_shifts, working_hours_dict
+
+        # Pages without the signature's row only give their key legend
+        if not date_list or not name_list:
+            legend_hours.append(get_working_hours_dict(tables))
+            continue
+        sign_found = True
+
+        add_page_shifts(collection, date_list, name_list, get_working_hours_dict(tables))
+
+    if not sign_found:
+        raise ValueError(f"No row found for the sign: {sign}")
+
+    for page_hours in legend_hours:
+        add_legend_hours(collection, page_hours)
+    return collection['work_shifts'], collection['working_hours_dict']
+
+
+def return_work_shifts_for_signs(_temp_pdf_file_path, signs=None):
+    """
+    Parse the PDF once and collect the shifts of several signatures.
+
+    :param _temp_pdf_file_path: str or file
+        The path of the PDF, or a file object with it, e.g. a BytesIO.
+    :param signs: list
+        The signatures to collect. None collects every signature in the schedule.
+
+    :return: dict
+        (work_shifts, working_hours_dict) for every signature, like return_work_shifts_and_working_keys.
+    """
+    collections = {}
+    # The key legend of every page and the signatures with a row on it
+    legends = []
+
+    for tables in iter_page_tables(_temp_pdf_file_path):
+        date_list, name_rows = extract_date_and_name_rows(tables, signs)
+        page_hours = get_working_hours_dict(tables)
+        if not date_list:
+            name_rows = {}
+        legends.append((page_hours, set(name_rows)))
+
+        for sign, name_list in name_rows.items():
+            add_page_shifts(collections.setdefault(sign, new_shift_collection()), date_list, name_list, page_hours)
+
+    missing = [sign for sign in (signs or []) if sign not in collections]
+    if missing:
+        raise ValueError(f"No row found for the signs: {', '.join(missing)}")
+
+    # Like for a single signature, the legends of pages without a signature's row only add keys
+    for sign, collection in collections.items():
+        for page_hours, page_signs in legends:
+            if sign not in page_signs:
+                add_legend_hours(collection, page_hours)
+
+    return {sign: (collection['work_shifts'], collection['working_hours_dict'])
+            for sign, collection in collections.items()}
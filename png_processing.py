@@ -2,80 +2,308 @@ import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 import pytesseract
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 import re
 import os
+import atexit
+import queue
+import bisect
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from ocr_cache import ocr_cache, make_key, MISS
+from layout_templates import layout_store
+from glyph_classifier import GlyphClassifier
+import metrics
+
+OCR_CALLS = metrics.counter('ocr_calls_total', 'Tesseract calls.')
+OCR_SECONDS = metrics.histogram('ocr_call_seconds', 'Seconds spent in one Tesseract call.')
+OCR_CACHE_REQUESTS = metrics.counter('ocr_cache_requests_total', 'OCR cache lookups by result (hit or miss).')
+GRID_LINES = metrics.histogram('png_grid_lines', 'Merged grid lines found in a screenshot by orientation.',
+                               metrics.SIZE_BUCKETS)
+GRID_CELLS = metrics.histogram('png_cells', 'Cells built from the grid of a screenshot.', metrics.SIZE_BUCKETS)
+STAGE_SECONDS = metrics.histogram('stage_seconds', 'Seconds spent in a pipeline stage.')
+GLYPH_READS = metrics.counter('glyph_reads_total', 'Digit cells read by the glyph classifier instead of Tesseract.')
+
+def find_white_runs(image, min_length):
+    """
+    Find all horizontal runs of white pixels in a binary image.
+
+    The runs are found with whole-array operations: the image is padded with a black column on each side
+    and the difference along each row marks where a run starts (+1) and where it ends (-1).
+
+    :param image: numpy array
+        The binary input image.
+    :param min_length: int
+        The minimum number of consecutive white pixels for a run to be kept.
+
+    :return: tuple of numpy arrays
+        The row, first column and end column (exclusive) of every run, in row-major order.
+    """
+    white = (image == 255).astype(np.int8)
+    padded = np.pad(white, ((0, 0), (1, 1)))
+    edges = np.diff(padded, axis=1)
+
+    # np.nonzero walks the array row by row, so starts and ends pair up in the same order
+    start_rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+
+    keep = (ends - starts) >= min_length
+    return start_rows[keep], starts[keep], ends[keep]
+
+
+# A detected grid line is stored as a span instead of a list of pixels.
+# 'fixed' is the y-coordinate of a horizontal line (x for a vertical one) and 'thickness' how many
+# neighbouring rows/columns the line covers. 'start' and 'end' (exclusive) give its extent along the line.
+LINE_DTYPE = np.dtype([('fixed', np.int32), ('thickness', np.int32), ('start', np.int32), ('end', np.int32)])
+
+
+def make_lines(fixed, starts, ends):
+    """
+    Pack one-pixel-thick runs into a structured array of line spans.
+
+    :param fixed: numpy array
+        The fixed coordinate of every run.
+    :param starts: numpy array
+        The first pixel of every run along the line.
+    :param ends: numpy array
+        The end (exclusive) of every run along the line.
+
+    :return: numpy array
+        The runs as an array with LINE_DTYPE.
+    """
+    lines = np.empty(len(fixed), dtype=LINE_DTYPE)
+    lines['fixed'] = fixed
+    lines['thickness'] = 1
+    lines['start'] = starts
+    lines['end'] = ends
+    return lines
+
 
-def detect_lines(image):
-    # Initialize two empty lists to store the horizontal and vertical lines
-    horizontal_lines = []
-    vertical_lines = []
+# The width of schema_pic.png. The pixel thresholds of the line detection are tuned for it and scale with
+# the width of other screenshots, so a screenshot taken at another DPI finds the same grid.
+REFERENCE_WIDTH = 2623
+
+
+def get_image_scale(image):
+    return image.shape[1] / REFERENCE_WIDTH
+
+
+def detect_lines(image, min_horizontal_length=None, min_vertical_length=None):
+    # The minimum lengths are 400 and 200 pixels at the width of schema_pic.png
+    scale = get_image_scale(image)
+    if min_horizontal_length is None:
+        min_horizontal_length = max(1, round(400 * scale))
+    if min_vertical_length is None:
+        min_vertical_length = max(1, round(200 * scale))
 
     # Scan the image for horizontal lines
-    for y in range(image.shape[0]):
-        white_pixels = []
-        for x in range(image.shape[1]):
-            if image[y, x] == 255:  # White pixel
-                white_pixels.append((x, y))
-            elif white_pixels:
-                if len(white_pixels) >= 400:
-                    horizontal_lines.append(white_pixels)
-                white_pixels = []
-        if white_pixels and len(white_pixels) >= 400:
-            horizontal_lines.append(white_pixels)
-
-    # Scan the image for vertical lines
-    for x in range(image.shape[1]):
-        white_pixels = []
-        for y in range(image.shape[0]):
-            if image[y, x] == 255:  # White pixel
-                white_pixels.append((x, y))
-            elif white_pixels:
-                if len(white_pixels) >= 200:
-                    vertical_lines.append(white_pixels)
-                white_pixels = []
-        if white_pixels and len(white_pixels) >= 200:
-            vertical_lines.append(white_pixels)
+    horizontal_lines = make_lines(*find_white_runs(image, min_horizontal_length))
+
+    # Scan the image for vertical lines by running the same search on the transposed image
+    vertical_lines = make_lines(*find_white_runs(image.T, min_vertical_length))
+
+    return horizontal_lines, vertical_lines
+
+def downscale_max(image, factor):
+    """
+    Downscale a binary image by keeping the brightest pixel of every factor x factor block.
+
+    Unlike averaging, this keeps one pixel wide grid lines white in the small image.
+
+    :param image: numpy array
+        The binary image.
+    :param factor: int
+        The downscaling factor.
+
+    :return: numpy array
+        The downscaled image, rounded up so that no pixel of the image is left out.
+    """
+    # Dilating with the kernel anchored at its top left corner puts the maximum of every block in its first pixel
+    return cv2.dilate(image, np.ones((factor, factor), np.uint8), anchor=(0, 0))[::factor, ::factor]
+
+
+def get_bands(lines, factor, size):
+    # The full resolution rows (or columns) around every coarse line, with a margin of one block on each side
+    bands = [np.arange(max(0, (fixed - 1) * factor), min(size, (fixed + thickness + 1) * factor))
+             for fixed, thickness in zip(lines['fixed'].tolist(), lines['thickness'].tolist())]
+    return np.unique(np.concatenate(bands)) if bands else np.empty(0, dtype=np.intp)
+
+
+def detect_lines_pyramid(image, factor, min_horizontal_length=None, min_vertical_length=None):
+    """
+    Detect the grid lines of a large screenshot coarse to fine.
+
+    The lines are first found in a copy downscaled by factor. Only the narrow bands of full resolution rows and
+    columns around them are then scanned, so the full image is never scanned line by line.
+
+    :param image: numpy array
+        The binary image, with the grid lines white.
+    :param factor: int
+        The downscaling factor of the coarse image.
+    :param min_horizontal_length: int
+        The minimum length of a horizontal line in full resolution pixels, scaled with the image by default.
+    :param min_vertical_length: int
+        The minimum length of a vertical line in full resolution pixels, scaled with the image by default.
+
+    :return: tuple of numpy arrays
+        The one pixel thick horizontal and vertical lines with LINE_DTYPE, like detect_lines.
+    """
+    scale = get_image_scale(image)
+    if min_horizontal_length is None:
+        min_horizontal_length = max(1, round(400 * scale))
+    if min_vertical_length is None:
+        min_vertical_length = max(1, round(200 * scale))
+
+    # Find the approximate lines in the small image
+    small_image = downscale_max(image, factor)
+    coarse_horizontal, coarse_vertical = detect_lines(small_image, min_horizontal_length // factor,
+                                                      min_vertical_length // factor)
+    coarse_horizontal = merge_lines(coarse_horizontal, True, 1, 1)
+    coarse_vertical = merge_lines(coarse_vertical, False, 1, 1)
+
+    # Refine them in the full resolution bands around the approximate lines
+    rows = get_bands(coarse_horizontal, factor, image.shape[0])
+    band_rows, starts, ends = find_white_runs(image[rows], min_horizontal_length)
+    horizontal_lines = make_lines(rows[band_rows], starts, ends)
+
+    columns = get_bands(coarse_vertical, factor, image.shape[1])
+    band_columns, starts, ends = find_white_runs(image[:, columns].T, min_vertical_length)
+    vertical_lines = make_lines(columns[band_columns], starts, ends)
 
     return horizontal_lines, vertical_lines
 
+
 def merge_lines(lines, is_horizontal=True, thickness_threshold=10, length_threshold=10):
-    if not lines:
-        return []
-
-    # Sorting criterion depends on whether the lines are horizontal or vertical
-    sort_index = 1 if is_horizontal else 0
-    lines.sort(key=lambda line: (line[0][sort_index], line[0][1-sort_index]))
-
-    merged_lines = []
-    current_line = lines[0]
-
-    for next_line in lines[1:]:
-        # Check whether the lines are neighboring and part of the same grid line
-        if abs(current_line[0][sort_index] - next_line[0][sort_index]) <= thickness_threshold and \
-                abs(current_line[-1][1-sort_index] - next_line[0][1-sort_index]) <= thickness_threshold:
-            # Merge the lines by taking union of pixels
-            current_line = list(set(current_line) | set(next_line))
-        else:
-            # Only add line if it exceeds the minimum length
-            if len(current_line) >= length_threshold:
-                merged_lines.append(current_line)
-            current_line = next_line
+    # The spans already store their fixed coordinate, so is_horizontal is only kept for existing callers
+    if len(lines) == 0:
+        return np.empty(0, dtype=LINE_DTYPE)
+
+    lines = np.sort(lines, order=['fixed', 'start'])
+
+    # Each merged line is [fixed, last fixed, start, end]. The runs are swept in the order of their fixed
+    # coordinate, and every merged line stays open while it ends within thickness_threshold of the sweep.
+    merged = []
+    open_lines = []
+    for fixed, _, start, end in lines.tolist():
+        open_lines = [line for line in open_lines if fixed - line[1] <= thickness_threshold]
+        # Merge the run into every open line whose extent overlaps or neighbors it. A run that touches
+        # several of them, e.g. a thin line next to two parts of a thick one, joins them into one.
+        touching = [line for line in open_lines
+                    if start - line[3] <= thickness_threshold and line[2] - end <= thickness_threshold]
+        if not touching:
+            line = [fixed, fixed, start, end]
+            merged.append(line)
+            open_lines.append(line)
+            continue
+        line = touching[0]
+        line[1] = max(line[1], fixed)
+        line[2] = min(line[2], start)
+        line[3] = max(line[3], end)
+        for other in touching[1:]:
+            line[0], line[1] = min(line[0], other[0]), max(line[1], other[1])
+            line[2], line[3] = min(line[2], other[2]), max(line[3], other[3])
+            open_lines.remove(other)
+            # Marked as merged, it is left out below
+            other[0] = None
+
+    merged_lines = np.array([(first, last - first + 1, start, end) for first, last, start, end in merged
+                             if first is not None], dtype=LINE_DTYPE)
+
+    # Only keep lines that exceed the minimum length
+    return merged_lines[(merged_lines['end'] - merged_lines['start']) >= length_threshold]
+
+
+# Whether screenshots are matched against learned layouts, so line detection can be skipped
+USE_LAYOUT_TEMPLATES = True
+
+
+def has_extra_lines(binary_image, horizontal_lines, vertical_lines):
+    """
+    Check whether a binary image has grid lines that a stored layout does not have.
 
-    # Add the last line if it exceeds the minimum length
-    if len(current_line) >= length_threshold:
-        merged_lines.append(current_line)
+    The stored lines being present is not enough, since a schedule with an extra row has all the lines of
+    the shorter one. The lines are searched in a copy downscaled 4 times at the width of schema_pic.png,
+    and every line found there must lie on one of the stored lines.
 
-    return merged_lines
+    :param binary_image: numpy array
+        The binary image, with the grid lines white.
+    :param horizontal_lines: numpy array
+        The stored horizontal lines with LINE_DTYPE.
+    :param vertical_lines: numpy array
+        The stored vertical lines with LINE_DTYPE.
 
+    :return: boolean
+        True if the image has a line that is not stored, so the layout does not match.
+    """
+    scale = get_image_scale(binary_image)
+    factor = max(2, round(4 * scale))
+    small_image = downscale_max(binary_image, factor)
+    coarse_horizontal, coarse_vertical = detect_lines(small_image, max(1, round(400 * scale)) // factor,
+                                                      max(1, round(200 * scale)) // factor)
+
+    for coarse_lines, lines in ((coarse_horizontal, horizontal_lines), (coarse_vertical, vertical_lines)):
+        # The coarse rows (or columns) covered by a stored line, with a margin of one block on each side
+        known = np.zeros(-(-binary_image.shape[0 if lines is horizontal_lines else 1] // factor) + 1, bool)
+        for fixed, thickness in zip(lines['fixed'].tolist(), lines['thickness'].tolist()):
+            known[max(0, fixed // factor - 1):(fixed + thickness - 1) // factor + 2] = True
+        if not known[coarse_lines['fixed']].all():
+            return True
+    return False
+
+# Whether screenshots at least twice as wide as schema_pic.png are searched coarse to fine
+USE_PYRAMID_DETECTION = True
+
+def get_grid_lines(binary_image):
+    """
+    Get the merged horizontal and vertical grid lines of a binary image.
 
-def get_cells(horizontal_lines, vertical_lines):
-    # Flatten the list of lines and separate the x and y coordinates
-    x_coords = {x for line in vertical_lines for x, _ in line}
-    y_coords = {y for line in horizontal_lines for _, y in line}
+    :param binary_image: numpy array
+        The binary image, with the grid lines white.
 
-    # Convert the sets to sorted lists
-    x_coords = sorted(list(x_coords))
-    y_coords = sorted(list(y_coords))
+    :return: tuple of numpy arrays
+        The merged horizontal and vertical lines with LINE_DTYPE.
+    """
+    if USE_LAYOUT_TEMPLATES:
+        layout = layout_store.find_png_layout(binary_image)
+        if layout is not None:
+            horizontal_lines, vertical_lines = (np.array([tuple(line) for line in lines], dtype=LINE_DTYPE)
+                                                for lines in layout)
+            if not has_extra_lines(binary_image, horizontal_lines, vertical_lines):
+                return horizontal_lines, vertical_lines
+
+    # Detect the lines in the image. One line is one pixel wide
+    scale = get_image_scale(binary_image)
+    factor = round(scale)
+    if USE_PYRAMID_DETECTION and factor >= 2:
+        horizontal_lines, vertical_lines = detect_lines_pyramid(binary_image, factor)
+    else:
+        horizontal_lines, vertical_lines = detect_lines(binary_image)
+
+    # Merge the lines to reduce them. The thresholds are 10 pixels at the width of schema_pic.png
+    threshold = max(1, round(10 * scale))
+    merged_horizontal_lines = merge_lines(horizontal_lines, True, threshold, threshold)
+    merged_vertical_lines = merge_lines(vertical_lines, False, threshold, threshold)
+
+    if USE_LAYOUT_TEMPLATES and len(merged_horizontal_lines) and len(merged_vertical_lines):
+        layout_store.learn_png_layout(binary_image, merged_horizontal_lines.tolist(), merged_vertical_lines.tolist())
+
+    return merged_horizontal_lines, merged_vertical_lines
+
+
+def get_line_edges(lines):
+    # Both outer edges of every line, so that cells are bounded by the inside of thick lines
+    return np.unique(np.concatenate([lines['fixed'], lines['fixed'] + lines['thickness'] - 1])).tolist()
+
+
+def get_cells(horizontal_lines, vertical_lines):
+    # Read the sorted x and y coordinates straight from the line spans
+    x_coords = get_line_edges(vertical_lines)
+    y_coords = get_line_edges(horizontal_lines)
 
     # Get the cells by finding the four corners for each consecutive pair of x and y coordinates
     cells = []
@@ -90,6 +318,82 @@ def get_cells(horizontal_lines, vertical_lines):
     return cells
 
 
+def get_cells_from_components(horizontal_lines, vertical_lines, shape):
+    """
+    Get the cells enclosed by the grid lines as the connected regions between them.
+
+    Unlike get_cells this does not combine every x coordinate with every y coordinate, so merged cells are one
+    cell and areas outside the table, where lines only run partly, do not produce phantom cells.
+
+    :param horizontal_lines: numpy array
+        The merged horizontal lines with LINE_DTYPE.
+    :param vertical_lines: numpy array
+        The merged vertical lines with LINE_DTYPE.
+    :param shape: tuple
+        The shape of the image.
+
+    :return: list
+        The cells in the same four-corner format and column by column order as get_cells. The corners lie on
+        the surrounding lines.
+    """
+    horizontal = horizontal_lines.tolist()
+    vertical = vertical_lines.tolist()
+
+    # Every region boundary lies on an edge of a line, so the regions can be labelled on a mask with one pixel
+    # per interval between neighbouring edges instead of on the full image
+    xs = np.unique([0, shape[1]] + [x for fixed, thickness, _, _ in vertical for x in (fixed, fixed + thickness)] +
+                   [x for _, _, start, end in horizontal for x in (start, end)])
+    ys = np.unique([0, shape[0]] + [y for fixed, thickness, _, _ in horizontal for y in (fixed, fixed + thickness)] +
+                   [y for _, _, start, end in vertical for y in (start, end)])
+
+    # Draw the lines on the compressed mask
+    grid_mask = np.full((len(ys) - 1, len(xs) - 1), 255, np.uint8)
+    for fixed, thickness, start, end in horizontal:
+        grid_mask[np.searchsorted(ys, fixed):np.searchsorted(ys, fixed + thickness),
+                  np.searchsorted(xs, start):np.searchsorted(xs, end)] = 0
+    for fixed, thickness, start, end in vertical:
+        grid_mask[np.searchsorted(ys, start):np.searchsorted(ys, end),
+                  np.searchsorted(xs, fixed):np.searchsorted(xs, fixed + thickness)] = 0
+
+    # Every region of the mask is bounded by lines, label 0 is the lines themselves
+    _, _, stats, _ = cv2.connectedComponentsWithStats(grid_mask, connectivity=4)
+    stats = stats[1:]
+    left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+    right, bottom = left + stats[:, cv2.CC_STAT_WIDTH], top + stats[:, cv2.CC_STAT_HEIGHT]
+
+    # Regions that reach the edge of the image are not closed by lines, so they are not cells
+    closed = (left > 0) & (top > 0) & (right < grid_mask.shape[1]) & (bottom < grid_mask.shape[0])
+    left, top, right, bottom = xs[left[closed]], ys[top[closed]], xs[right[closed]], ys[bottom[closed]]
+    order = np.lexsort((top, left))
+
+    return [[(x0 - 1, y0 - 1), (x1, y0 - 1), (x0 - 1, y1), (x1, y1)]
+            for x0, y0, x1, y1 in zip(left[order].tolist(), top[order].tolist(), right[order].tolist(),
+                                      bottom[order].tolist())]
+
+
+# How cells are built from the grid lines. 'grid' combines every x and y coordinate of the lines,
+# 'components' finds the regions enclosed by the lines with cv2.connectedComponentsWithStats.
+CELL_ENGINE = os.environ.get('CELL_ENGINE', 'grid')
+
+
+def build_cells(horizontal_lines, vertical_lines, shape, engine=None):
+    """
+    Build the cells of the grid with the chosen engine.
+
+    :param engine: str
+        'grid' or 'components', defaults to CELL_ENGINE.
+
+    :return: list
+        The cells, each as its four corners.
+    """
+    engine = engine or CELL_ENGINE
+    if engine == 'grid':
+        return get_cells(horizontal_lines, vertical_lines)
+    if engine == 'components':
+        return get_cells_from_components(horizontal_lines, vertical_lines, shape)
+    raise ValueError(f"Unknown cell engine: {engine}")
+
+
 def filter_cells_by_dimensions(cells, min_width=20, min_height=20):
     filtered_cells = []
 
@@ -104,6 +408,69 @@ def filter_cells_by_dimensions(cells, min_width=20, min_height=20):
 
     return filtered_cells
 
+
+class GridIndex:
+    """
+    Index over the detected cells, built once per image.
+
+    Every cell is stored under its (row, col) position among the sorted line coordinates, so the cells
+    on a row, the cells to the right of a cell and the cell containing a point are found with bisect
+    or direct indexing instead of a pass over every cell.
+    """
+
+    def __init__(self, cells):
+        self.x_coords = sorted({x for cell in cells for x, _ in cell})
+        self.y_coords = sorted({y for cell in cells for _, y in cell})
+
+        self.cells = {}
+        # Every (row, col) covered by a cell, more than one for cells that span several rows or columns
+        self.covering = {}
+        for cell in cells:
+            row, col = self.position_of(cell)
+            self.cells[(row, col)] = cell
+            for covered_row in range(row, max(bisect.bisect_left(self.y_coords, cell[3][1]), row + 1)):
+                for covered_col in range(col, max(bisect.bisect_left(self.x_coords, cell[3][0]), col + 1)):
+                    self.covering[(covered_row, covered_col)] = cell
+
+        # Columns and cells of every row, sorted from left to right
+        self.row_columns = {}
+        self.row_cells = {}
+        for row, col in sorted(self.cells):
+            self.row_columns.setdefault(row, []).append(col)
+            self.row_cells.setdefault(row, []).append(self.cells[(row, col)])
+
+    def position_of(self, cell):
+        """Get the (row, col) of a cell from its top left corner"""
+        return bisect.bisect_left(self.y_coords, cell[0][1]), bisect.bisect_left(self.x_coords, cell[0][0])
+
+    def row_at(self, y):
+        """Get the row whose y range contains y"""
+        return bisect.bisect_right(self.y_coords, y) - 1
+
+    def column_at(self, x):
+        """Get the column whose x range contains x"""
+        return bisect.bisect_right(self.x_coords, x) - 1
+
+    def cell_at(self, x, y):
+        """Get the cell containing the point (x, y), or None"""
+        return self.covering.get((self.row_at(y), self.column_at(x)))
+
+    def cells_on_row(self, row, after_column=None):
+        """Get the cells on a row, optionally only those to the right of a column"""
+        cells = self.row_cells.get(row, [])
+        if after_column is None:
+            return list(cells)
+        return cells[bisect.bisect_right(self.row_columns[row], after_column):] if cells else []
+
+    def cells_below(self, y):
+        """Get the cells whose bottom edge is at or below y, column by column like get_cells"""
+        first_row = max(bisect.bisect_left(self.y_coords, y) - 1, 0)
+        return [self.cells[(row, col)]
+                for col in range(len(self.x_coords))
+                for row in range(first_row, len(self.y_coords))
+                if (row, col) in self.cells]
+
+
 def rescale_image(image, new_height=35):
     # Get the current dimensions of the image
     original_height, original_width = image.shape[:2]
@@ -146,6 +513,94 @@ def is_cell_empty(image, variance_threshold=2000):
     #The threshold 2000 is usally enough for an empty cell
     return np.var(image) < variance_threshold
 
+
+# What has been worked out about every page that is being read, e.g. its integral images, so that every batch
+# of cells on it can use it. Keyed by id(image) with a weak reference to the page, so concurrent requests
+# keep the data of their own pages and the data is freed together with the page.
+page_states = {}
+page_state_lock = threading.Lock()
+
+def get_page_data(image):
+    """
+    Get the dictionary kept for a page, empty for a page that was not seen before.
+
+    The dictionary is freed together with the page.
+    """
+    key = id(image)
+    with page_state_lock:
+        state = page_states.get(key)
+        if state is None or state[0]() is not image:
+            state = page_states[key] = (weakref.ref(image, lambda _: page_states.pop(key, None)), {})
+        return state[1]
+
+
+def get_page_integrals(image):
+    """
+    Get the sum and squared sum integral images of a page, computed once per page.
+
+    :param image: numpy array
+        The grayscale page.
+
+    :return: tuple
+        The sum and squared sum integral images from cv2.integral2, one row and column larger than the page.
+        Both are 64 bit floats, which hold the sums of any page size exactly.
+    """
+    data = get_page_data(image)
+    with page_state_lock:
+        if 'integrals' not in data:
+            data['integrals'] = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        return data['integrals']
+
+
+def get_page_classifier(image):
+    """Get the glyph classifier that learns the digits of a page from its confident Tesseract reads"""
+    data = get_page_data(image)
+    with page_state_lock:
+        return data.setdefault('classifier', GlyphClassifier())
+
+
+def find_empty_cells(image, cells, variance_threshold=2000):
+    """
+    Check which cells are more or less empty, with the same variance test as is_cell_empty.
+
+    The variance of every cell is looked up in the integral images of the page, so the cells are not cropped.
+
+    :param image: numpy array
+        The grayscale page.
+    :param cells: list
+        The cells, each in the format [top_left, top_right, bottom_left, bottom_right].
+    :param variance_threshold: int
+        The threshold for variance to consider a cell as empty.
+
+    :return: numpy array
+        True for every empty cell.
+    """
+    if not cells:
+        return np.zeros(0, bool)
+    sums, squared_sums = get_page_integrals(image)
+
+    # Keep the corners on the page
+    corners = np.array([(cell[0][0], cell[0][1], cell[3][0], cell[3][1]) for cell in cells])
+    x0, x1 = (np.clip(corners[:, index], 0, image.shape[1]) for index in (0, 2))
+    y0, y1 = (np.clip(corners[:, index], 0, image.shape[0]) for index in (1, 3))
+
+    def area_sum(integral):
+        corners = [integral[y, x] for y, x in ((y1, x1), (y0, x1), (y1, x0), (y0, x0))]
+        return corners[0] - corners[1] - corners[2] + corners[3]
+
+    pixels = np.maximum(x1 - x0, 0) * np.maximum(y1 - y0, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = area_sum(sums) / pixels
+        variance = area_sum(squared_sums) / pixels - mean * mean
+    # Cells without pixels are not empty, np.var of an empty crop is not below any threshold either
+    return (pixels > 0) & (variance < variance_threshold)
+
+
+def drop_empty_cells(image, cells):
+    # Keep the cells that have something to read, in the same order
+    empty = find_empty_cells(image, cells)
+    return [cell for cell, cell_empty in zip(cells, empty) if not cell_empty]
+
 def move_cell(cell, direction, move_pixels=5):
     """
     Move the boundaries of a cell in a certain direction by a certain number of pixels.
@@ -184,28 +639,40 @@ def move_cell(cell, direction, move_pixels=5):
     return new_cell
 
 
+def leading_true(values):
+    # The number of True values before the first False
+    return len(values) if values.all() else int(np.argmin(values))
+
+
 def remove_frame(image, threshold=150):
-    while True:
-        # Check if the borders are uniformly colored
-        top_row = image[0, :]
-        bottom_row = image[-1, :]
-        left_col = image[:, 0]
-        right_col = image[:, -1]
-
-        # If the borders are uniform and in a shade of black, remove them
-        if np.all(top_row < threshold):
-            image = image[1:, :]
-        elif np.all(bottom_row < threshold):
-            image = image[:-1, :]
-        elif np.all(left_col < threshold):
-            image = image[:, 1:]
-        elif np.all(right_col < threshold):
-            image = image[:, :-1]
-        else:
-            # If no borders are uniformly colored and in a shade of black, stop the loop
+    """
+    Remove the rows and columns at the edges of a cell crop that are dark all the way, i.e. the cell frame.
+
+    A border row can be removed once it is dark over the columns that are left, so the rows and columns are
+    removed from the projection profiles of the dark pixels until nothing changes.
+
+    :param image: numpy array
+        The cell crop.
+    :param threshold: int
+        Pixels darker than this count as frame.
+
+    :return: numpy array
+        The crop without its frame, empty if the whole crop is dark.
+    """
+    dark = image < threshold
+    top, bottom, left, right = 0, image.shape[0], 0, image.shape[1]
+    while top < bottom and left < right:
+        window = dark[top:bottom, left:right]
+        dark_rows = window.all(axis=1)
+        dark_columns = window.all(axis=0)
+        if dark_rows.all() or dark_columns.all():
+            return image[:0, :0]
+        if not (dark_rows[0] or dark_rows[-1] or dark_columns[0] or dark_columns[-1]):
             break
+        top, bottom = top + leading_true(dark_rows), bottom - leading_true(dark_rows[::-1])
+        left, right = left + leading_true(dark_columns), right - leading_true(dark_columns[::-1])
 
-    return image
+    return image[top:bottom, left:right]
 
 def remove_border(image, threshold=50):
     while True:
@@ -291,6 +758,258 @@ def erode_image(image, cell, kernel_size=5):
 
     return eroded_image
 
+def parse_tesseract_config(config):
+    """
+    Split a Tesseract command line config into its page segmentation mode and variables.
+
+    :param config: str
+        The config, e.g. '--psm 7 -c tessedit_char_whitelist=0123456789'.
+
+    :return: tuple
+        The page segmentation mode (None if not given) and a dictionary with the variables.
+    """
+    psm = None
+    variables = {}
+    parts = config.split()
+    for i, part in enumerate(parts[:-1]):
+        if part == '--psm':
+            psm = int(parts[i + 1])
+        elif part == '-c':
+            name, _, value = parts[i + 1].partition('=')
+            variables[name] = value
+    return psm, variables
+
+
+class PytesseractBackend:
+    """
+    Runs the tesseract binary through pytesseract. Every call starts a new process and loads the
+    language model again, so this is the slow fallback.
+    """
+    name = 'pytesseract'
+
+    def image_to_data(self, image, config):
+        data = pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DICT)
+        return {key: data[key] for key in ('text', 'conf', 'left', 'top', 'width', 'height')}
+
+
+class TesserocrBackend:
+    """
+    Runs Tesseract in-process through the tesserocr C-API binding. Engines are kept in a pool and lent to
+    one call at a time, so the language model is loaded once per concurrent call instead of once per call,
+    and images are passed as numpy buffers without temporary files. close() ends all engines.
+    """
+    name = 'tesserocr'
+
+    def __init__(self, lang='eng'):
+        self.lang = lang
+        # Idle engines, and every engine that was started so close() can end them
+        self.idle = queue.LifoQueue()
+        self.engines = []
+        self.lock = threading.Lock()
+        # Start one engine right away so a missing language model is noticed when the backend is chosen
+        self.release(self.acquire())
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            engine = {'api': tesserocr.PyTessBaseAPI(lang=self.lang), 'variables': set()}
+            with self.lock:
+                self.engines.append(engine)
+            return engine
+
+    def release(self, engine):
+        self.idle.put(engine)
+
+    def close(self):
+        """End all engines of the pool. Engines that are still lent out are ended as well."""
+        with self.lock:
+            engines, self.engines = self.engines, []
+        for engine in engines:
+            engine['api'].End()
+        self.idle = queue.LifoQueue()
+
+    def image_to_data(self, image, config):
+        engine = self.acquire()
+        try:
+            return self.recognize(engine, image, config)
+        finally:
+            self.release(engine)
+
+    def recognize(self, engine, image, config):
+        api = engine['api']
+        psm, variables = parse_tesseract_config(config)
+
+        # Variables stay set on the engine, so clear the ones from the previous call first
+        for name in engine['variables'] - set(variables):
+            api.SetVariable(name, '')
+        for name, value in variables.items():
+            api.SetVariable(name, value)
+        engine['variables'] = set(variables)
+        api.SetPageSegMode(tesserocr.PSM.SINGLE_BLOCK if psm is None else psm)
+
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        api.SetImageBytes(image.tobytes(), width, height, 1, width)
+        api.Recognize()
+
+        data = {'text': [], 'conf': [], 'left': [], 'top': [], 'width': [], 'height': []}
+        iterator = api.GetIterator()
+        if iterator is not None:
+            for word in tesserocr.iterate_level(iterator, tesserocr.RIL.WORD):
+                text = word.GetUTF8Text(tesserocr.RIL.WORD)
+                box = word.BoundingBox(tesserocr.RIL.WORD)
+                if text is None or box is None:
+                    continue
+                left, top, right, bottom = box
+                data['text'].append(text)
+                data['conf'].append(word.Confidence(tesserocr.RIL.WORD))
+                data['left'].append(left)
+                data['top'].append(top)
+                data['width'].append(right - left)
+                data['height'].append(bottom - top)
+        return data
+
+
+OCR_BACKENDS = {'pytesseract': PytesseractBackend, 'tesserocr': TesserocrBackend}
+ocr_backend = None
+ocr_backend_lock = threading.Lock()
+
+
+def get_ocr_backend():
+    """
+    Get the OCR backend, creating it on first use.
+
+    The backend is chosen with the OCR_BACKEND environment variable. By default tesserocr is used
+    when it is installed, and pytesseract when it is not or when its engine cannot be started.
+    """
+    global ocr_backend
+    with ocr_backend_lock:
+        if ocr_backend is None:
+            name = os.environ.get('OCR_BACKEND', 'tesserocr' if tesserocr is not None else 'pytesseract')
+            if name not in OCR_BACKENDS:
+                raise ValueError(f"Unknown OCR backend: {name}")
+            try:
+                ocr_backend = OCR_BACKENDS[name]()
+            except (AttributeError, RuntimeError) as e:
+                print(f"Could not start the {name} OCR backend, falling back to pytesseract: {e}")
+                ocr_backend = PytesseractBackend()
+            if hasattr(ocr_backend, 'close'):
+                atexit.register(ocr_backend.close)
+        return ocr_backend
+
+
+def ocr_key(image, config, step=None):
+    # Backends read the same pixels differently, so their results are cached apart
+    return make_key(image, config, step, get_ocr_backend().name)
+
+
+# The number of Tesseract calls and the seconds spent in them, read by the benchmark and the metrics
+ocr_call_stats = {'calls': 0, 'seconds': 0.0}
+ocr_call_stats_lock = threading.Lock()
+
+
+def run_ocr(image, config):
+    """Run the OCR backend on an image and count the call in ocr_call_stats"""
+    start = time.perf_counter()
+    try:
+        return get_ocr_backend().image_to_data(image, config)
+    finally:
+        seconds = time.perf_counter() - start
+        with ocr_call_stats_lock:
+            ocr_call_stats['calls'] += 1
+            ocr_call_stats['seconds'] += seconds
+        OCR_CALLS.inc()
+        OCR_SECONDS.observe(seconds)
+
+
+# Tesseract settings and the pattern a read must match for every cell type.
+# 'digit' is used for shift keys, 'date' for the date row and 'hours' for the time ranges in the key legend.
+# Shift keys are mostly numbers, but letter keys like F, FM or Ö also occur, so 'digit' has no whitelist.
+CELL_TYPES = {
+    None: {'config': '--psm 7', 'pattern': re.compile(r".+")},
+    'digit': {'config': '--psm 10',
+              'pattern': re.compile(r"[\dA-ZÅÄÖ:-]+")},
+    'date': {'config': '--psm 7 -c tessedit_char_whitelist=0123456789-abcdefgjklmnoprstuv',
+             'pattern': re.compile(r"\d{1,2}-[a-z]{3}")},
+    'hours': {'config': '--psm 7 -c tessedit_char_whitelist=0123456789:-',
+              'pattern': re.compile(r"\d{1,2}[:-]\d{2}(\s*-?\s*\d{1,2}[:-]\d{2})*")},
+}
+
+# A read with at least this mean word confidence that matches the cell type's pattern is accepted
+OCR_MIN_CONFIDENCE = 70
+# Whether digit cells are first read by a glyph classifier learned from the page's own confident Tesseract
+# reads, and the confidence a read needs to become one of its templates
+USE_GLYPH_CLASSIFIER = True
+GLYPH_MIN_CONFIDENCE = 90
+
+
+def crop_moved_cell(image, cell, direction):
+    new_cell = move_cell(cell, direction, 10)
+    return image[new_cell[0][1]:new_cell[3][1], new_cell[0][0]:new_cell[3][0]]
+
+# The images read_cell tries, in the order of OCR_STEPS, until one of them gives a confident read.
+# Each step gets the whole image, the cell and the cell's crop with the frame removed.
+OCR_STEP_IMAGES = {
+    'framed': lambda image, cell, framed: framed,
+    'rescaled': lambda image, cell, framed: rescale_image(framed),
+    'moved_down': lambda image, cell, framed: crop_moved_cell(image, cell, 'down'),
+    'moved_up': lambda image, cell, framed: crop_moved_cell(image, cell, 'up'),
+    'moved_left': lambda image, cell, framed: crop_moved_cell(image, cell, 'left'),
+    'moved_right': lambda image, cell, framed: crop_moved_cell(image, cell, 'right'),
+    'dilated': lambda image, cell, framed: dilate_image(image, cell, 3),
+    'eroded': lambda image, cell, framed: erode_image(image, cell, 3),
+}
+# Can be reordered or pruned with the statistics from rank_ocr_steps
+OCR_STEPS = ['framed', 'rescaled', 'moved_down', 'moved_up', 'moved_left', 'moved_right', 'dilated', 'eroded']
+
+# How often every step was tried and how often it gave the accepted read
+ocr_step_stats = {step: {'tried': 0, 'succeeded': 0} for step in OCR_STEP_IMAGES}
+ocr_step_stats_lock = threading.Lock()
+
+
+def rank_ocr_steps(min_tries=1):
+    """
+    Rank the OCR steps by how often they gave the accepted read.
+
+    :param min_tries: int
+        Steps that were tried fewer times than this are left out.
+
+    :return: list
+        (step, tried, success rate) tuples, the most successful step first.
+    """
+    with ocr_step_stats_lock:
+        ranking = [(step, stats['tried'], stats['succeeded'] / stats['tried'])
+                   for step, stats in ocr_step_stats.items() if stats['tried'] >= min_tries]
+    return sorted(ranking, key=lambda item: item[2], reverse=True)
+
+
+def ocr_image(image, config, step=None):
+    """
+    Run Tesseract on an image, or return the cached result if the same pixels were read before.
+
+    :param image: numpy array
+        The image to read.
+    :param config: str
+        The Tesseract config.
+    :param step: str
+        The read_cell step that made the image, stored as part of the cache key.
+
+    :return: tuple
+        The words found by Tesseract joined by spaces, and their mean confidence (-1 if there are none).
+    """
+    key = ocr_key(image, config, step)
+    result = ocr_cache.get(key)
+    OCR_CACHE_REQUESTS.inc(result='miss' if result is MISS else 'hit')
+    if result is MISS:
+        data = run_ocr(image, config)
+        words = [(text.strip(), float(conf)) for text, conf in zip(data['text'], data['conf']) if text.strip()]
+        text = ' '.join(text for text, _ in words)
+        confidence = sum(conf for _, conf in words) / len(words) if words else -1
+        result = [text, confidence]
+        ocr_cache.set(key, result)
+    return result[0], result[1]
+
 def read_cell(image, cell, type=None, print = False):
     if not isinstance(image, np.ndarray) or image.ndim != 2:
         raise ValueError("Input image must be a 2D numpy array.")
@@ -301,6 +1020,9 @@ def read_cell(image, cell, type=None, print = False):
     if not all(0 <= x < image.shape[1] and 0 <= y < image.shape[0] for x, y in cell):
         raise ValueError("Cell points must lie within the image bounds.")
 
+    if type not in CELL_TYPES:
+        raise ValueError(f"Unknown cell type: {type}")
+
     cell_contents = {}
 
     # Define cell boundaries
@@ -312,9 +1034,8 @@ def read_cell(image, cell, type=None, print = False):
     #Check if cell is more or less empty
 
     cell_empty = is_cell_empty(cell_image)
-    config = '--psm 7'
-    if type == 'digit':
-        config= '--psm 10'
+    config = CELL_TYPES[type]['config']
+    pattern = CELL_TYPES[type]['pattern']
     if cell_empty:
         text = 'empty'
 
@@ -322,81 +1043,244 @@ def read_cell(image, cell, type=None, print = False):
         #cell_image = crop_borders(cell_image,2)
         cell_image = remove_frame(cell_image, 50)
 
-        # Use Tesseract to extract the text from the cell
-        text = pytesseract.image_to_string(cell_image, config=config).strip()  # strip() is used to remove leading and trailing white space
-
-        if text == "":
-            cell_image = rescale_image(cell_image)
-            text = pytesseract.image_to_string(cell_image, config=config).strip()
-        directions = ['down', 'up', 'left', 'right']
-
-        for direction in directions:
-            if text == "":
-                new_cell = move_cell(cell, direction, 10)
-                cell_image_moved = image[new_cell[0][1]:new_cell[3][1], new_cell[0][0]:new_cell[3][0]]
-                text = pytesseract.image_to_string(cell_image_moved, config=config).strip()
-            else:
+        # Try the steps in order and stop at the first confident read that looks like the cell type.
+        # If none is confident, the read with the highest confidence is kept.
+        text, best_confidence = "", -1
+        for step in OCR_STEPS:
+            step_image = OCR_STEP_IMAGES[step](image, cell, cell_image)
+            if step_image.size == 0:
+                continue
+            step_text, confidence = ocr_image(step_image, config, step)
+            accepted = confidence >= OCR_MIN_CONFIDENCE and pattern.fullmatch(step_text) is not None
+
+            with ocr_step_stats_lock:
+                ocr_step_stats[step]['tried'] += 1
+                if accepted:
+                    ocr_step_stats[step]['succeeded'] += 1
+
+            if accepted:
+                text = step_text
+                # Confident reads of the plain crop teach the glyph classifier the digits of this page
+                if type == 'digit' and USE_GLYPH_CLASSIFIER and step == 'framed' and \
+                        confidence >= GLYPH_MIN_CONFIDENCE:
+                    get_page_classifier(image).add(step_image, step_text)
                 break
-        if text == "":
-            dilated_image = dilate_image(image, cell, 3)
-            text = pytesseract.image_to_string(dilated_image, config=config).strip()
-        if text == "":
-            eroded_image = erode_image(image, cell, 3)
-            text = pytesseract.image_to_string(eroded_image, config=config).strip()
-        if text == "":
-            text = pytesseract.image_to_string(cell_image, config='--psm 10')
-            if text == 'oO\n':
-                text == ""
-        if text == "":
-            print('Cant regognize')
-            plt.figure(figsize=(5,5))
-            plt.imshow(cell_image, cmap='gray')
-            plt.show()
-            print(cell)
-
-    rect = [top_left, (bottom_right[0], top_left[1]), (top_left[0], bottom_right[1]), bottom_right]
+            if step_text and confidence > best_confidence:
+                text, best_confidence = step_text, confidence
+
+    rect = get_rect(cell)
     if print: print_image(cell_image)
     cell_contents = {'rect': rect, 'content': text}
     return cell_contents
 
-def get_cells_on_row(all_cells, reference_cell, only_right=False):
-    # Get the y-coordinates of the reference cell
-    reference_y_top = reference_cell[0][1]
-    reference_y_bottom = reference_cell[2][1]
 
-    # Calculate the y-coordinate of the middle point of the reference cell
-    reference_y_mid = (reference_y_top + reference_y_bottom) / 2
+def get_rect(cell):
+    """Get the rectangle stored with a read cell from the cell's corners"""
+    top_left = cell[0]
+    bottom_right = cell[3]
+    return [top_left, (bottom_right[0], top_left[1]), (top_left[0], bottom_right[1]), bottom_right]
+
+
+# Number of cells pasted into one mosaic image and the white space kept around every crop
+MOSAIC_CELLS = 40
+MOSAIC_PADDING = 10
+# Cells where a word of the mosaic read has a lower confidence than this are read again one by one
+MOSAIC_MIN_CONFIDENCE = 60
+
+def build_mosaic(crops, padding=MOSAIC_PADDING):
+    """
+    Paste cell crops below each other on a white image.
+
+    :param crops: list
+        The cropped cell images.
+    :param padding: int
+        The number of white pixels around every crop.
+
+    :return: tuple
+        The mosaic image and the (top, bottom) y range that belongs to every crop.
+    """
+    width = max(crop.shape[1] for crop in crops) + 2 * padding
+    height = sum(crop.shape[0] + padding for crop in crops) + padding
+    mosaic = np.full((height, width), 255, dtype=np.uint8)
+
+    slots = []
+    y = padding
+    for crop in crops:
+        crop_height, crop_width = crop.shape[:2]
+        mosaic[y:y + crop_height, padding:padding + crop_width] = crop
+        # Half of the padding on each side belongs to the crop, so every word box lands in exactly one slot
+        slots.append((y - padding // 2, y + crop_height + padding // 2))
+        y += crop_height + padding
+
+    return mosaic, slots
+
+
+def read_mosaic(crops):
+    """
+    Read a list of crops with a single Tesseract call.
+
+    :param crops: list
+        The cropped cell images.
+
+    :return: list
+        (text, confidence) for every crop, where the confidence is the lowest of its words. The text is None
+        where the read was empty or unclear.
+    """
+    mosaic, slots = build_mosaic(crops)
+    slot_tops = [top for top, _ in slots]
+    data = run_ocr(mosaic, '--psm 6')
+
+    words = [[] for _ in crops]
+    confidences = [100.0] * len(crops)
+    unclear = [False] * len(crops)
+    for text, conf, top, height in zip(data['text'], data['conf'], data['top'], data['height']):
+        text = text.strip()
+        if not text:
+            continue
+        # Map the word back to the crop whose slot holds the middle of its box
+        middle = top + height / 2
+        index = bisect.bisect_right(slot_tops, middle) - 1
+        if index < 0 or middle >= slots[index][1]:
+            continue
+        words[index].append(text)
+        confidences[index] = min(confidences[index], float(conf))
+        if float(conf) < MOSAIC_MIN_CONFIDENCE:
+            unclear[index] = True
+
+    return [(' '.join(crop_words) if crop_words and not crop_unclear else None, confidence)
+            for crop_words, crop_unclear, confidence in zip(words, unclear, confidences)]
+
+
+def classify_pending(classifier, pending, texts):
+    # Read the pending crops that the classifier recognises and return the ones it does not
+    if classifier is None or not pending:
+        return pending
+    classified = classifier.classify([crop for _, crop, _ in pending])
+    GLYPH_READS.inc(sum(text is not None for text in classified))
+    for (i, _, _), text in zip(pending, classified):
+        if text is not None:
+            texts[i] = text
+    return [item for item, text in zip(pending, classified) if text is None]
+
+
+def read_cells_mosaic(image, cells, type=None, classifier=None):
+    """
+    Read many cells by pasting them into mosaic images and running Tesseract once per mosaic.
+
+    Empty cells are found for the whole batch at once and never sent to Tesseract. With a glyph classifier
+    the crops it recognises are not sent either, and after every mosaic it learns from the confident reads
+    and tries the crops that are still pending again.
+
+    :param image: numpy array
+        The grayscale input image.
+    :param cells: list
+        The cells to read, each in the format [top_left, top_right, bottom_left, bottom_right].
+    :param type: str
+        The cell type. Reads that do not match its pattern in CELL_TYPES count as unclear.
+    :param classifier: GlyphClassifier
+        The classifier of the page for digit cells, or None.
+
+    :return: list
+        The {'rect', 'content'} dictionaries like read_cell returns them, or None for every cell
+        the mosaic read left empty or unclear.
+    """
+    texts = [None] * len(cells)
+    pending = []
+    for i, (cell, cell_empty) in enumerate(zip(cells, find_empty_cells(image, cells))):
+        if cell_empty:
+            texts[i] = 'empty'
+            continue
+        cell_image = remove_frame(image[cell[0][1]:cell[3][1], cell[0][0]:cell[3][0]], 50)
+        if not cell_image.size:
+            continue
+        # Crops that were read in an earlier mosaic are taken from the cache
+        key = ocr_key(cell_image, '--psm 6', 'mosaic')
+        text = ocr_cache.get(key)
+        OCR_CACHE_REQUESTS.inc(result='miss' if text is MISS else 'hit')
+        if text is MISS:
+            pending.append((i, cell_image, key))
+        else:
+            texts[i] = text
+
+    pending = classify_pending(classifier, pending, texts)
+    while pending:
+        chunk, pending = pending[:MOSAIC_CELLS], pending[MOSAIC_CELLS:]
+        for (i, crop, key), (text, confidence) in zip(chunk, read_mosaic([crop for _, crop, _ in chunk])):
+            ocr_cache.set(key, text)
+            texts[i] = text
+            if classifier is not None and text is not None and confidence >= GLYPH_MIN_CONFIDENCE:
+                classifier.add(crop, text)
+        pending = classify_pending(classifier, pending, texts)
+
+    pattern = CELL_TYPES[type]['pattern']
+    return [{'rect': get_rect(cell), 'content': text}
+            if text is not None and (text == 'empty' or pattern.fullmatch(text)) else None
+            for cell, text in zip(cells, texts)]
+
+
+# Default size of the worker pool used by read_cells. Tesseract either runs as a subprocess or
+# releases the GIL inside tesserocr, so threads are enough to keep every core busy.
+OCR_MAX_WORKERS = os.cpu_count() or 1
+# Whether read_cells first tries to read the whole batch through mosaic images
+OCR_BATCH_MODE = True
+
+def read_cells(image, cells, type=None, max_workers=None):
+    """
+    Read a batch of cells concurrently.
 
-    # Get the x-coordinate of the right edge and left edge of the reference cell
-    reference_x_right = reference_cell[2][0]
-    reference_x_left = reference_cell[0][0]
+    With OCR_BATCH_MODE the cells are first read through mosaic images, and only the cells that read
+    leaves empty or unclear are read one by one with read_cell. With USE_GLYPH_CLASSIFIER, digit cells
+    that the page's glyph classifier recognises are not sent to Tesseract at all.
 
-    # Initialize an empty list to store the row cells
-    row_cells = []
+    :param image: numpy array
+        The grayscale input image.
+    :param cells: list
+        The cells to read, each in the format [top_left, top_right, bottom_left, bottom_right].
+    :param type: str
+        The cell type passed on to read_cell, e.g. 'digit'.
+    :param max_workers: int
+        The number of cells read at the same time. Defaults to OCR_MAX_WORKERS.
 
-    # Iterate over all cells
-    for cell in all_cells:
-        # Get the y-coordinates of the current cell
-        cell_y_top = cell[0][1]
-        cell_y_bottom = cell[2][1]
+    :return: list
+        The {'rect', 'content'} dictionaries from read_cell, in the same order as cells.
+    """
+    classifier = get_page_classifier(image) if type == 'digit' and USE_GLYPH_CLASSIFIER else None
+    if OCR_BATCH_MODE:
+        results = read_cells_mosaic(image, cells, type, classifier)
+    else:
+        # Empty cells are answered from the integral images before any OCR is scheduled
+        results = [{'rect': get_rect(cell), 'content': 'empty'} if cell_empty else None
+                   for cell, cell_empty in zip(cells, find_empty_cells(image, cells))]
+        if classifier is not None:
+            pending = [(i, remove_frame(image[cell[0][1]:cell[3][1], cell[0][0]:cell[3][0]], 50), None)
+                       for i, (cell, result) in enumerate(zip(cells, results)) if result is None]
+            texts = [None] * len(cells)
+            classify_pending(classifier, pending, texts)
+            for i, text in enumerate(texts):
+                if text is not None:
+                    results[i] = {'rect': get_rect(cells[i]), 'content': text}
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    max_workers = min(max_workers or OCR_MAX_WORKERS, len(missing))
+    if max_workers <= 1:
+        cells_read = [read_cell(image, cells[i], type) for i in missing]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            cells_read = list(executor.map(lambda i: read_cell(image, cells[i], type), missing))
 
-        # Get the x-coordinate of the left and right edge of the current cell
-        cell_x_left = cell[0][0]
-        cell_x_right = cell[2][0]
+    for i, cell_content in zip(missing, cells_read):
+        results[i] = cell_content
+    return results
 
-        # Check if the reference cell's middle point falls within the y-coordinates of the current cell
-        if cell_y_top <= reference_y_mid <= cell_y_bottom:
-            # Check if we only want cells on the right or all cells on the same row
-            if only_right:
-                # Only consider the cell if it is to the right of the reference cell
-                if cell_x_left > reference_x_right:
-                    row_cells.append(cell)
-            else:
-                # Consider all cells on the same row
-                if cell_x_right >= reference_x_left or cell_x_left <= reference_x_right:
-                    row_cells.append(cell)
+def get_cells_on_row(grid, reference_cell, only_right=False):
+    # The row is the one containing the middle point of the reference cell
+    reference_y_mid = (reference_cell[0][1] + reference_cell[2][1]) / 2
+    row = grid.row_at(reference_y_mid)
 
-    return row_cells
+    # Check if we only want cells on the right or all cells on the same row
+    if only_right:
+        return grid.cells_on_row(row, after_column=grid.column_at(reference_cell[0][0]))
+    return grid.cells_on_row(row)
 
 
 def remove_empty_cells(cells):
@@ -465,23 +1349,36 @@ def retrieve_cells_by_exact_content(cells, content):
 
     return matched_cells
 
+# A cell holding a date of the date row, e.g. '27-mar'
+DATE_PATTERN = re.compile(r"\b(0[1-9]|1[0-9]|2[0-9]|3[0-1])-(jan|feb|mar|apr|maj|jun|jul|aug|sep|okt|nov|dec)\b")
+# A signature in the name column
+SIGN_PATTERN = re.compile(r'[A-ZÅÄÖ]{2,4}')
+
+
+def sign_search_patterns(sign):
+    # The signature as it may be read, with and without Swedish characters
+    return [sign.lower(), sign.lower().replace('ö', 'o'), sign.lower().replace('ä', 'a'), sign.lower().replace('å', 'a')]
+
+
+def matches_sign(text, sign):
+    return any(pattern in text.lower() for pattern in sign_search_patterns(sign))
+
+
 def return_sign_and_date_cell(image, cells, sign):
     sign_cell = None
     date_cell = None
 
-    # Create additional search patterns for the sign
-    search_patterns = [sign.lower(), sign.lower().replace('ö', 'o'), sign.lower().replace('ä', 'a'), sign.lower().replace('å', 'a')]
-
-    for cell in cells:
+    # Empty cells can contain neither, so they are skipped without reading them
+    for cell in drop_empty_cells(image, cells):
         # Read the cell
         cell_content = read_cell(image, cell)
 
         # Check cell content for "sign" and store the cell if found
-        if any(pattern in cell_content['content'].lower() for pattern in search_patterns) and sign_cell is None:
+        if matches_sign(cell_content['content'], sign) and sign_cell is None:
             sign_cell = cell_content
 
         # Check cell content for the date regex and store the cell if found
-        elif re.match(r"\b(0[1-9]|1[0-9]|2[0-9]|3[0-1])-(jan|feb|mar|apr|maj|jun|jul|aug|sep|okt|nov|dec)\b", cell_content['content'].lower()) and date_cell is None:
+        elif DATE_PATTERN.match(cell_content['content'].lower()) and date_cell is None:
             date_cell = cell_content
 
         # If both "sign" and a date have been found, stop reading cells
@@ -497,9 +1394,15 @@ def return_sign_and_date_cell(image, cells, sign):
     return sign_cell, date_cell
 
 
-def get_hours_keys(unique_numbers_in_row, cells_filtered, gray_image):
+# The key legend is in the lower 40% of the image
+LEGEND_TOP = 0.6
+# A time in the key legend, e.g. '7:30'
+HOURS_PATTERN = re.compile(r"\b\d{1,2}[:-]\d{2}\b")
+
+
+def get_hours_keys(unique_numbers_in_row, grid, gray_image, max_workers=None):
     # Assuming page_height is the height of your page, define the start of the lower 40%
-    lower_40_threshold = gray_image.shape[0] * 0.6
+    lower_40_threshold = gray_image.shape[0] * LEGEND_TOP
 
     # Copy your set of numbers so you can modify it while iterating
     numbers_to_find = unique_numbers_in_row.copy()
@@ -507,16 +1410,13 @@ def get_hours_keys(unique_numbers_in_row, cells_filtered, gray_image):
     # Create an empty list to store the cell contents
     cell_contents_hours_key = []
 
-    # Iterate over cells
-    for cell in cells_filtered:
-        # Get the 'y' attribute as the vertical position
-        y_position = max(coord[1] for coord in cell)
-
-        # Check if the cell is in the lower 40% of the image
-        if y_position >= lower_40_threshold:
-
-            # Read cell and get the content
-            cell_content = read_cell(gray_image,cell, 'digit', False)
+    # Read the cells in the lower 40% of the image one batch at a time, so that we can stop early
+    cells = grid.cells_below(lower_40_threshold)
+    batch_size = max_workers or OCR_MAX_WORKERS
+    for i in range(0, len(cells), batch_size):
+        if len(numbers_to_find) == 0:
+            break
+        for cell_content in read_cells(gray_image, cells[i:i + batch_size], 'digit', max_workers):
             text = cell_content['content']
             # If the cell_content is a digit and is in our numbers_to_find
             if text.isdigit() and int(text) in numbers_to_find:
@@ -531,10 +1431,10 @@ def get_hours_keys(unique_numbers_in_row, cells_filtered, gray_image):
     return cell_contents_hours_key
 
 
-def get_list_of_working_hours(cell_contents_hours_key, cells_filtered, gray_image):
-    def get_list_of_working_hours(cell_contents_hours_key, cells_filtered, gray_image):
-        if not isinstance(cell_contents_hours_key, list) or not isinstance(cells_filtered, list):
-            raise ValueError("Both cell_contents_hours_key and cells_filtered must be lists.")
+def get_list_of_working_hours(cell_contents_hours_key, grid, gray_image, max_workers=None):
+    def get_list_of_working_hours(cell_contents_hours_key, grid, gray_image):
+        if not isinstance(cell_contents_hours_key, list) or not isinstance(grid, GridIndex):
+            raise ValueError("cell_contents_hours_key must be a list and grid a GridIndex.")
 
         if not isinstance(gray_image, np.ndarray) or gray_image.ndim != 2:
             raise ValueError("gray_image must be a 2D numpy array.")
@@ -542,15 +1442,18 @@ def get_list_of_working_hours(cell_contents_hours_key, cells_filtered, gray_imag
         if not cell_contents_hours_key:
             raise ValueError("cell_contents_hours_key cannot be empty.")
 
+    # Read the six cells to the right of every key in one batch
+    cells_to_right = [get_cells_on_row(grid, cell['rect'], only_right=True)[:6] for cell in cell_contents_hours_key]
+    subcells_read = iter(read_cells(gray_image, [subcell for row in cells_to_right for subcell in row],
+                                    'hours', max_workers))
+
     working_hours_list = []
-    for cell in cell_contents_hours_key:
+    for cell, row in zip(cell_contents_hours_key, cells_to_right):
         dic = {}
         dic['work_key'] = cell['content']
         dic['hours'] = []
-        cells_to_right = get_cells_on_row(cells_filtered, cell['rect'], only_right=True)
-        for subcell in cells_to_right[:6]:
-            subcell_content = read_cell(gray_image, subcell, type = 'digit', print = False)
-            matches = re.findall(r"\b\d{1,2}[:-]\d{2}\b", subcell_content['content'])
+        for subcell_content in (next(subcells_read) for _ in row):
+            matches = HOURS_PATTERN.findall(subcell_content['content'])
             if matches: dic['hours'].extend(matches)  # extend the list with new matches
         working_hours_list.append(dic)
     return working_hours_list
@@ -561,16 +1464,11 @@ def get_mid_x(rect):
     x_right = rect[2][0]
     return (x_left + x_right) / 2
 
-def find_corresponding_cell(mid_x, sign_row_read):
-    """Find the corresponding cell in sign_row_read that has mid_x within its x range"""
-    for cell in sign_row_read:
-        x_left = cell['rect'][0][0]
-        x_right = cell['rect'][2][0]
-        if x_left <= mid_x <= x_right:
-            return cell
-    return None
+def find_corresponding_cell(mid_x, sign_row_by_column, grid):
+    """Find the corresponding cell in the signature row that is in the column containing mid_x"""
+    return sign_row_by_column.get(grid.column_at(mid_x))
 
-def combine_date_and_work_key(date_cells_filtered, sign_row_read):
+def combine_date_and_work_key(date_cells_filtered, sign_row_read, grid):
     if not isinstance(date_cells_filtered, list) or not isinstance(sign_row_read, list):
         raise ValueError("Both date_cells_filtered and sign_row_read must be lists.")
 
@@ -579,9 +1477,12 @@ def combine_date_and_work_key(date_cells_filtered, sign_row_read):
 
     result_list = []
 
+    # Look up the signature row cells by their column instead of searching the row for every date
+    sign_row_by_column = {grid.column_at(cell['rect'][0][0]): cell for cell in reversed(sign_row_read)}
+
     for date_cell in date_cells_filtered:
         mid_x = get_mid_x(date_cell['rect'])
-        corresponding_cell = find_corresponding_cell(mid_x, sign_row_read)
+        corresponding_cell = find_corresponding_cell(mid_x, sign_row_by_column, grid)
 
         if corresponding_cell is not None:
             result_list.append({'date': date_cell['content'], 'work_hours': corresponding_cell['content']})
@@ -614,23 +1515,114 @@ def combine_hours(working_hours_list):
 
     return new_dict
 
+# Whether the key legend is read in one pass before keys are looked up cell by cell
+USE_LEGEND_EXTRACTOR = True
+
+
+def read_legend(gray_image, grid):
+    """
+    Read the whole key legend with a single Tesseract call.
+
+    The cells in the lower 40% of the image are read as one strip. Every cell holding only a number is a key,
+    and its hours are the times in the six cells to its right, like get_list_of_working_hours reads them.
+    The legend is kept with the page, so every signature of the same image uses the same read.
+
+    :param gray_image: numpy array
+        The grayscale input image.
+    :param grid: GridIndex
+        The cells of the image.
+
+    :return: dict
+        The hours of every key in the legend, in the format of combine_hours.
+    """
+    data = get_page_data(gray_image)
+    with page_state_lock:
+        if 'legend' in data:
+            return data['legend']
+
+    cells = grid.cells_below(gray_image.shape[0] * LEGEND_TOP)
+    working_hours_list = []
+    if cells:
+        # The bounding box of the legend
+        left, top = min(cell[0][0] for cell in cells), min(cell[0][1] for cell in cells)
+        right, bottom = max(cell[3][0] for cell in cells), max(cell[3][1] for cell in cells)
+        texts = {grid.position_of(cell_content['rect']): cell_content['content']
+                 for cell_content in read_words_into_cells(gray_image, grid, left, top, right, bottom)}
+
+        keys_seen = set()
+        for cell in cells:
+            text = texts.get(grid.position_of(cell), '')
+            if not text.isdigit() or text in keys_seen:
+                continue
+            keys_seen.add(text)
+            hours = []
+            for subcell in get_cells_on_row(grid, cell, only_right=True)[:6]:
+                hours.extend(HOURS_PATTERN.findall(texts.get(grid.position_of(subcell), '')))
+            working_hours_list.append({'work_key': text, 'hours': hours})
+
+    legend = combine_hours(working_hours_list)
+    with page_state_lock:
+        return data.setdefault('legend', legend)
+
+
+def get_working_hours(numbers, grid, gray_image, max_workers=None):
+    """
+    Get the hours of the keys used in signature rows.
+
+    The keys are taken from the legend read in one pass. Keys it misses, or reads without any hours, are
+    looked up cell by cell.
+
+    :param numbers: set
+        The keys to look up.
+
+    :return: dict
+        The hours of every key found, in the format of combine_hours.
+    """
+    working_hours_dict = {}
+    found = set()
+    if USE_LEGEND_EXTRACTOR:
+        for key, hours in read_legend(gray_image, grid).items():
+            if hours and int(key) in numbers and int(key) not in found:
+                working_hours_dict[key] = hours
+                found.add(int(key))
+
+    missing = numbers - found
+    if missing:
+        cell_contents_hours_key = get_hours_keys(missing, grid, gray_image, max_workers)
+        working_hours_dict.update(combine_hours(
+            get_list_of_working_hours(cell_contents_hours_key, grid, gray_image, max_workers)))
+    return working_hours_dict
+
+
 filepath = 'schema_pic.png'
 signature = 'DOF'
 
-def return_work_shifts_and_working_keys(signature, filepath):
+def read_image(filepath):
+    # Decode an in-memory upload without writing it to disk
+    if not isinstance(filepath, (str, os.PathLike)):
+        if hasattr(filepath, 'getbuffer'):
+            # A BytesIO is decoded from its buffer without copying it
+            with filepath.getbuffer() as buffer:
+                return cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_COLOR)
+        if hasattr(filepath, 'read'):
+            filepath.seek(0)
+            filepath = filepath.read()
+        return cv2.imdecode(np.frombuffer(filepath, np.uint8), cv2.IMREAD_COLOR)
+
     # Check if the file exists
     if not os.path.isfile(filepath):
         raise ValueError(f"File {filepath} does not exist.")
     # Load the image in full color
-    color_image = cv2.imread(filepath, cv2.IMREAD_COLOR)
+    return cv2.imread(filepath, cv2.IMREAD_COLOR)
+
+
+def load_schedule_grid(filepath):
+    # filepath is the path of the image, its bytes or a file object with it, e.g. a BytesIO
+    color_image = read_image(filepath)
 
     # Check if the image is readable
     if color_image is None:
-        raise ValueError(f"Could not read the file {filepath} as an image.")
-
-    # Check if the signature is valid
-    if not isinstance(signature, str) or signature == "":
-        raise ValueError("Signature must be a non-empty string.")
+        raise ValueError("Could not read the file as an image.")
 
     # Convert the color image to grayscale
     gray_image = cv2.cvtColor(color_image, cv2.COLOR_BGR2GRAY)
@@ -642,69 +1634,289 @@ def return_work_shifts_and_working_keys(signature, filepath):
     # Threshold the image to get a binary image
     _, binary_image = cv2.threshold(gray_image, 150, 255, cv2.THRESH_BINARY_INV)
 
-    # Detect the lines in the image. One line is one pixel wide
-    horizontal_lines, vertical_lines = detect_lines(binary_image)
-
-    # Merge the lines to reduce them
-    merged_horizontal_lines = merge_lines(horizontal_lines, True)
-    merged_vertical_lines = merge_lines(vertical_lines, False)
+    # Reuse the grid lines of a known layout, or detect and merge them and remember the layout
+    with STAGE_SECONDS.time(stage='png_grid_lines'):
+        merged_horizontal_lines, merged_vertical_lines = get_grid_lines(binary_image)
+    GRID_LINES.observe(len(merged_horizontal_lines), orientation='horizontal')
+    GRID_LINES.observe(len(merged_vertical_lines), orientation='vertical')
 
     # Makes a grid of cells according to the lines. Each cell has four points to mark its corners.
-    cells = get_cells(merged_horizontal_lines, merged_vertical_lines)
+    cells = build_cells(merged_horizontal_lines, merged_vertical_lines, binary_image.shape)
+    GRID_CELLS.observe(len(cells))
 
     # Check if the cells are detected
     if not cells:
         raise ValueError("No cells detected in the image.")
 
-    # Filters the cells so that they need to be at least 10x10 pixels
-    cells_filtered = filter_cells_by_dimensions(cells, 10, 10)
+    # Filters the cells so that they need to be at least 10x10 pixels at the width of schema_pic.png
+    min_size = max(1, round(10 * get_image_scale(gray_image)))
+    cells_filtered = filter_cells_by_dimensions(cells, min_size, min_size)
 
-    # Reads the first 200 cells until it finds the signature and a cell that contains a date and returns it
-    sign_cell, date_cell = return_sign_and_date_cell(gray_image, cells_filtered[:200], signature)
+    # Index the cells by row and column for the lookups below
+    grid = GridIndex(cells_filtered)
+
+    return gray_image, cells_filtered, grid
 
-    # Check if the signature and date cells are detected
-    if sign_cell is None or date_cell is None:
-        raise ValueError("Could not detect the signature and date cells.")
 
+def read_date_row(gray_image, grid, date_cell, max_workers=None):
     # Get the coordinates of all the date cells that are on the row of the one we found.
-    date_cells = get_cells_on_row(cells_filtered, date_cell['rect'])
+    date_cells = get_cells_on_row(grid, date_cell['rect'])
 
     # Reads the image of all the date-cells and stores it in a list with dictionaries
-    date_cells_read = [read_cell(gray_image,cell) for cell in date_cells]
+    date_cells_read = read_cells(gray_image, date_cells, 'date', max_workers)
 
     # Filters empty cells
     date_cells_filtered = remove_empty_cells(date_cells_read)
     # Removes all cells that don't have a dash in it = no date
     date_cells_filtered = remove_cells_without_dash(date_cells_filtered)
     # If any date wrong, this function tries to correct that. Not foolproof, i.e. the first date is read wrong.
-    date_cells_filtered = fix_cell_dates(date_cells_filtered)
+    return fix_cell_dates(date_cells_filtered)
+
+
+def get_row_numbers(sign_row_read):
+    # The unique number values of a signature row
+    return {int(cell['content']) for cell in sign_row_read if
+            cell['content'].isdigit() and len(cell['content']) <= 2 and int(cell['content']) > 0}
+
+
+def return_work_shifts_and_working_keys(signature, filepath, max_workers=None):
+    # Check if the signature is valid
+    if not isinstance(signature, str) or signature == "":
+        raise ValueError("Signature must be a non-empty string.")
+
+    gray_image, cells_filtered, grid = load_schedule_grid(filepath)
+
+    # Reads the name column and the header band to find the signature and a cell that contains a date.
+    # If they are not found there, reads the first 200 cells until it finds them.
+    located = locate_sign_and_date_cells(gray_image, grid, [signature]) if USE_STRIP_LOCATOR else None
+    if located is not None and signature in located[0]:
+        sign_cell, date_cell = located[0][signature], located[1]
+    else:
+        sign_cell, date_cell = return_sign_and_date_cell(gray_image, cells_filtered[:200], signature)
+
+    # Check if the signature and date cells are detected
+    if sign_cell is None or date_cell is None:
+        raise ValueError("Could not detect the signature and date cells.")
+
+    date_cells_filtered = read_date_row(gray_image, grid, date_cell, max_workers)
 
     # Gets the coordinates for all the cells on the row of the signature
-    sign_row = get_cells_on_row(cells_filtered, sign_cell['rect'])
+    sign_row = get_cells_on_row(grid, sign_cell['rect'])
 
     # Reads the image of all the cells in the signature row
-    sign_row_read = [read_cell(gray_image,cell, 'digit') for cell in sign_row]
+    sign_row_read = read_cells(gray_image, sign_row, 'digit', max_workers)
 
     sign_row_read = filter_content(sign_row_read)
 
     # Stores a set with all the unique number values of the row corresponding to the signature
-    unique_numbers_in_row = {int(cell['content']) for cell in sign_row_read if
-                             cell['content'].isdigit() and len(cell['content']) <= 2 and int(cell['content']) > 0}
+    unique_numbers_in_row = get_row_numbers(sign_row_read)
 
-    # Reads the lower 40% of the image until it finds all the unique numbers we want.
-    # Then returns a list of dictionaries
-    cell_contents_hours_key = get_hours_keys(unique_numbers_in_row, cells_filtered, gray_image)
-
-    # Reads the following 6 cells to the right of the unique numbers, getting a list of dictionaries
-    working_hours_list = get_list_of_working_hours(cell_contents_hours_key, cells_filtered, gray_image)
-
-    # Converts the list to a dictionary that can be read by cal-functions.
-    working_hours_dict = combine_hours(working_hours_list)
+    # Reads the key legend in the lower 40% of the image once per image and takes the hours of the unique
+    # numbers we want, as a dictionary that can be read by cal-functions. Keys it misses are read cell by cell.
+    working_hours_dict = get_working_hours(unique_numbers_in_row, grid, gray_image, max_workers)
 
     # Combines the date with the corresponding number on the sign row by its coordinates. Stores it in a list of dictionaries
-    work_shifts = combine_date_and_work_key(date_cells_filtered, sign_row_read)
+    work_shifts = combine_date_and_work_key(date_cells_filtered, sign_row_read, grid)
 
     return work_shifts, working_hours_dict
 
 
+def find_date_cell(image, cells):
+    # Reads the cells until one contains a date, empty cells cannot contain one
+    for cell in drop_empty_cells(image, cells):
+        cell_content = read_cell(image, cell)
+        if DATE_PATTERN.match(cell_content['content'].lower()):
+            return cell_content
+    raise ValueError("No cell found containing a valid date. Try uploading a file with higher quality")
+
+
+def find_sign_cells(gray_image, grid, date_cell, signs=None, max_workers=None, known_rows=()):
+    # The signatures are in the first cell of every row below the date row, read them in one batch.
+    # Rows in known_rows already have their signature, e.g. from the strip read, and are not read again.
+    date_row = grid.row_at((date_cell['rect'][0][1] + date_cell['rect'][2][1]) / 2)
+    first_cells = [grid.row_cells[row][0] for row in sorted(grid.row_cells)
+                   if row > date_row and row not in known_rows]
+
+    sign_cells = {}
+    for cell_content in read_cells(gray_image, first_cells, None, max_workers):
+        text = cell_content['content'].strip()
+        if signs is None:
+            if SIGN_PATTERN.fullmatch(text):
+                sign_cells.setdefault(text, cell_content)
+            continue
+        for sign in signs:
+            if sign not in sign_cells and matches_sign(text, sign):
+                sign_cells[sign] = cell_content
+    return sign_cells
+
+
+# Whether the signatures and the date row are first located by reading the name column and the header band
+# as two strips, instead of reading cells one by one
+USE_STRIP_LOCATOR = True
+# Sparse text, since the strips hold the words of many cells
+STRIP_CONFIG = '--psm 11'
+# White space added around a strip, Tesseract misses words that touch the edge of the image
+STRIP_PADDING = 10
+
+
+def read_strip(image, left, top, right, bottom):
+    """
+    Read a part of the image with a single Tesseract call.
+
+    :param image: numpy array
+        The grayscale input image.
+    :param left: int
+    :param top: int
+    :param right: int
+    :param bottom: int
+        The part of the image to read.
+
+    :return: list
+        (text, x, y) for every word, where x and y are the middle of its box in the image.
+    """
+    strip = cv2.copyMakeBorder(image[top:bottom, left:right], STRIP_PADDING, STRIP_PADDING, STRIP_PADDING,
+                               STRIP_PADDING, cv2.BORDER_CONSTANT, value=255)
+    key = ocr_key(strip, STRIP_CONFIG, 'strip')
+    words = ocr_cache.get(key)
+    OCR_CACHE_REQUESTS.inc(result='miss' if words is MISS else 'hit')
+    if words is MISS:
+        data = run_ocr(strip, STRIP_CONFIG)
+        words = [[text.strip(), left + word_left + width / 2 - STRIP_PADDING,
+                  top + word_top + height / 2 - STRIP_PADDING]
+                 for text, word_left, word_top, width, height
+                 in zip(data['text'], data['left'], data['top'], data['width'], data['height']) if text.strip()]
+        ocr_cache.set(key, words)
+    return words
+
+
+def read_words_into_cells(image, grid, left, top, right, bottom):
+    """
+    Read a part of the image as one strip and put the words into the cells that hold them.
+
+    :return: list
+        {'rect', 'content'} dictionaries like read_cell returns them, for the cells that hold words,
+        from top to bottom and left to right.
+    """
+    cell_words = {}
+    for text, x, y in read_strip(image, left, top, right, bottom):
+        position = (grid.row_at(y), grid.column_at(x))
+        if position in grid.cells:
+            cell_words.setdefault(position, []).append(text)
+    return [{'rect': get_rect(grid.cells[position]), 'content': ' '.join(words)}
+            for position, words in sorted(cell_words.items())]
 
+
+def locate_sign_and_date_cells(image, grid, signs=None):
+    """
+    Find the signature cells and a date cell with two Tesseract calls.
+
+    The first column of the grid is read as one tall strip, which gives the row of every signature.
+    The band of the table above the first signature is then read as one wide strip, which gives the date row.
+
+    :param image: numpy array
+        The grayscale input image.
+    :param grid: GridIndex
+        The cells of the image.
+    :param signs: list
+        The signatures to find. None finds every signature in the name column.
+
+    :return: tuple
+        The {'rect', 'content'} of every signature found below the date row, of the date cell, and the set of
+        grid rows where the name column strip held any word. None when the strips do not show a signature or
+        a date, so that the cells have to be read one by one.
+    """
+    if len(grid.x_coords) < 2 or len(grid.y_coords) < 2:
+        return None
+    table_top, table_bottom = grid.y_coords[0], grid.y_coords[-1]
+    column = read_words_into_cells(image, grid, grid.x_coords[0], table_top, grid.x_coords[1], table_bottom)
+
+    sign_cells = {}
+    for cell_content in column:
+        text = cell_content['content'].strip()
+        candidates = signs if signs is not None else [text] if SIGN_PATTERN.fullmatch(text) else []
+        for sign in candidates:
+            if sign not in sign_cells and matches_sign(text, sign):
+                sign_cells[sign] = cell_content
+    if not sign_cells:
+        return None
+
+    # The dates are in the header above the first signature of the column
+    first_sign_top = min([cell_content['rect'][0][1] for cell_content in column
+                          if SIGN_PATTERN.fullmatch(cell_content['content'].strip())] +
+                         [cell_content['rect'][0][1] for cell_content in sign_cells.values()])
+    header = read_words_into_cells(image, grid, grid.x_coords[0], table_top, grid.x_coords[-1], first_sign_top)
+    date_cell = next((cell_content for cell_content in header
+                      if DATE_PATTERN.match(cell_content['content'].lower())), None)
+    if date_cell is None:
+        return None
+
+    date_row = grid.row_at((date_cell['rect'][0][1] + date_cell['rect'][2][1]) / 2)
+    sign_cells = {sign: cell_content for sign, cell_content in sign_cells.items()
+                  if grid.row_at((cell_content['rect'][0][1] + cell_content['rect'][2][1]) / 2) > date_row}
+    strip_rows = {grid.row_at((cell_content['rect'][0][1] + cell_content['rect'][2][1]) / 2)
+                  for cell_content in column}
+    return sign_cells, date_cell, strip_rows
+
+
+def return_work_shifts_for_signs(filepath, signs=None, max_workers=None):
+    """
+    Parse the screenshot once and collect the shifts of several signatures.
+
+    The grid, the date row and the key legend are read once, only the signature rows are read per signature.
+
+    :param filepath: str or file
+        The path of the screenshot, its bytes or a file object with it, e.g. a BytesIO.
+    :param signs: list
+        The signatures to collect. None collects every signature in the first column below the date row.
+    :param max_workers: int
+        The number of threads used for OCR.
+
+    :return: dict
+        (work_shifts, working_hours_dict) for every signature, like return_work_shifts_and_working_keys.
+    """
+    gray_image, cells_filtered, grid = load_schedule_grid(filepath)
+
+    # Locate the date row and the signatures with two strip reads, or by reading the cells
+    located = locate_sign_and_date_cells(gray_image, grid, signs) if USE_STRIP_LOCATOR else None
+    if located is not None:
+        sign_cells, date_cell, strip_rows = located
+    else:
+        sign_cells, date_cell, strip_rows = {}, find_date_cell(gray_image, cells_filtered[:200]), set()
+    date_cells_filtered = read_date_row(gray_image, grid, date_cell, max_workers)
+
+    # Read the cells of the name column that the strip may have missed one by one, empty ones are screened
+    # out without OCR. When every signature is wanted, only the rows where the strip found no word at all are
+    # read. When some given signatures were not in the strip, every row without a signature is read, since
+    # the strip may have misread them.
+    missing = None if signs is None else [sign for sign in signs if sign not in sign_cells]
+    if missing is None or missing:
+        known_rows = {grid.row_at((sign_cell['rect'][0][1] + sign_cell['rect'][2][1]) / 2)
+                      for sign_cell in sign_cells.values()}
+        if signs is None:
+            known_rows |= strip_rows
+        for sign, sign_cell in find_sign_cells(gray_image, grid, date_cell, missing, max_workers,
+                                               known_rows).items():
+            sign_cells.setdefault(sign, sign_cell)
+
+    # Fall back to the search of the single signature path for signatures outside the first column
+    for sign in signs or []:
+        if sign not in sign_cells:
+            sign_cells[sign], _ = return_sign_and_date_cell(gray_image, cells_filtered[:200], sign)
+
+    # Read every signature row in one batch
+    sign_rows = {sign: get_cells_on_row(grid, sign_cell['rect']) for sign, sign_cell in sign_cells.items()}
+    rows_read = iter(read_cells(gray_image, [cell for row in sign_rows.values() for cell in row], 'digit',
+                                max_workers))
+    sign_rows_read = {sign: filter_content([next(rows_read) for _ in row]) for sign, row in sign_rows.items()}
+
+    # Look up the hours of every key used by any of the signatures at once
+    numbers_in_rows = {sign: get_row_numbers(row_read) for sign, row_read in sign_rows_read.items()}
+    all_numbers = set().union(*numbers_in_rows.values())
+    working_hours_dict = get_working_hours(all_numbers, grid, gray_image, max_workers)
+
+    results = {}
+    for sign, sign_row_read in sign_rows_read.items():
+        sign_hours = {key: hours for key, hours in working_hours_dict.items()
+                      if key.isdigit() and int(key) in numbers_in_rows[sign]}
+        results[sign] = (combine_date_and_work_key(date_cells_filtered, sign_row_read, grid), sign_hours)
+    return results
@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from cache_store import LruDict, write_json, remove_file, prune_directory
+
+
+def make_upload_key(data, file_extension):
+    """
+    Build the cache key of an uploaded schedule from its bytes.
+
+    :param data: bytes or BytesIO
+        The uploaded file.
+    :param file_extension: str
+        The file extension, e.g. '.pdf', since the same bytes are parsed differently per type.
+
+    :return: str
+        The SHA-256 hex digest of the file type and the bytes.
+    """
+    digest = hashlib.sha256()
+    digest.update(file_extension.lower().encode('utf-8'))
+    digest.update(b'|')
+    if hasattr(data, 'getbuffer'):
+        # Hash the buffer of a BytesIO without copying it
+        with data.getbuffer() as buffer:
+            digest.update(buffer)
+    else:
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class ScheduleCache:
+    """
+    Parsed schedules keyed by the hash of the uploaded file.
+
+    A parsed schedule is the (work_shifts, working_hours_dict) of the signatures parsed so far, and whether
+    that is every signature in the file, so a later upload of the same file is a lookup. The cache holds at
+    most max_entries schedules, evicts the least recently used one and drops schedules older than ttl
+    seconds. With a directory the schedules are also stored on disk, one JSON file per key, so they survive
+    restarts and are shared by worker processes.
+    """
+
+    def __init__(self, max_entries=100, ttl=24 * 60 * 60, directory=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.entries = LruDict(max_entries)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        """
+        Get the parsed schedule of an upload, or None.
+
+        :return: tuple
+            {sign: (work_shifts, working_hours_dict)} and whether it holds every signature in the file.
+        """
+        with self.lock:
+            if key in self.entries:
+                created, schedule, complete = self.entries.get(key)
+                if not self._expired(created):
+                    self.hits += 1
+                    return schedule, complete
+                self.entries.pop(key)
+
+        if self.directory:
+            path = self._path(key)
+            try:
+                with open(path, encoding='utf-8') as file:
+                    data = json.load(file)
+                created = data['created']
+                schedule = {sign: (work_shifts, working_hours_dict)
+                            for sign, (work_shifts, working_hours_dict) in data['schedule'].items()}
+                # Files written before partial schedules were cached always hold every signature
+                complete = data.get('complete', True)
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+            else:
+                if self._expired(created):
+                    remove_file(path)
+                else:
+                    with self.lock:
+                        self.entries.set(key, (created, schedule, complete))
+                        self.disk_hits += 1
+                    return schedule, complete
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, schedule, complete=True):
+        created = time.time()
+        with self.lock:
+            self.entries.set(key, (created, schedule, complete))
+
+        if self.directory:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                write_json(self._path(key), {'created': created, 'schedule': schedule, 'complete': complete})
+            except OSError as e:
+                print(f"Could not save the parsed schedule to {self.directory}: {e}")
+            # Remove expired schedules and the oldest ones above max_entries from the disk
+            prune_directory(self.directory, self.max_entries, self.ttl)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses}
+
+
+# The cache used by main. Set SCHEDULE_CACHE_DIR to share parsed schedules between worker processes.
+schedule_cache = ScheduleCache(max_entries=int(os.environ.get('SCHEDULE_CACHE_SIZE', 100)),
+                               ttl=float(os.environ.get('SCHEDULE_CACHE_TTL', 24 * 60 * 60)),
+                               directory=os.environ.get('SCHEDULE_CACHE_DIR'))
@@ -0,0 +1,264 @@
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import pdf_processing
+import png_processing
+from cal_functions import return_calendar
+from schedule_cache import schedule_cache, make_upload_key
+import metrics
+
+SCHEDULE_CACHE_REQUESTS = metrics.counter('schedule_cache_requests_total',
+                                          'Parsed schedule cache lookups by result (hit or miss).')
+STAGE_SECONDS = metrics.histogram('stage_seconds', 'Seconds spent in a pipeline stage.')
+JOB_SECONDS = metrics.histogram('job_seconds', 'Seconds from submitting an async job until it finished, by status.')
+
+PARSERS = {'.pdf': pdf_processing, '.png': png_processing}
+
+
+def normalize_sign(sign):
+    # Signatures are upper case in the schedules, so 'dof ' and 'DOF' are the same signature
+    return sign.strip().upper()
+
+
+def cache_parsed_signs(key, parsed, complete=False):
+    """
+    Add parsed signatures to the cached schedule of an upload.
+
+    :param key: str
+        The upload key from make_upload_key.
+    :param parsed: dict
+        (work_shifts, working_hours_dict) for every parsed signature.
+    :param complete: bool
+        Whether parsed holds every signature in the file.
+
+    :return: dict
+        The cached schedule with the parsed signatures.
+    """
+    cached = schedule_cache.get(key)
+    schedule, cached_complete = cached if cached is not None else ({}, False)
+    # The cached schedule can be read by other requests, so store a new one instead of changing it
+    schedule = {**schedule, **parsed}
+    schedule_cache.set(key, schedule, complete or cached_complete)
+    return schedule
+
+
+def parse_schedule(file_data, file_extension, signs=None):
+    """
+    Get the shifts of the signatures in an uploaded schedule.
+
+    Parsed signatures are cached under the hash of the upload, so later uploads of the same file are a lookup.
+    On a miss only the signatures that are not cached yet are parsed, all of them in one pass. A single missing
+    signature is parsed with return_work_shifts_and_working_keys, which only reads the parts of the file that
+    hold it.
+
+    :param file_data: bytes or BytesIO
+        The uploaded file. It is parsed from memory and never written to disk.
+    :param file_extension: str
+        '.pdf' or '.png'.
+    :param signs: list
+        The signatures to return, in any case. None returns every signature in the schedule.
+
+    :return: dict
+        (work_shifts, working_hours_dict) for every signature, keyed by the signatures as they were given.
+    """
+    parser = PARSERS[file_extension]
+    key = make_upload_key(file_data, file_extension)
+    cached = schedule_cache.get(key)
+    schedule, complete = cached if cached is not None else ({}, False)
+
+    wanted = None if signs is None else {sign: normalize_sign(sign) for sign in signs}
+    if wanted is None:
+        missing, hit = None, complete
+    else:
+        missing = sorted({sign for sign in wanted.values() if sign not in schedule})
+        hit = not missing
+    SCHEDULE_CACHE_REQUESTS.inc(result='hit' if hit else 'miss')
+
+    if not hit:
+        # A BytesIO made from bytes shares their memory, so this does not copy the upload
+        file = file_data if hasattr(file_data, 'getbuffer') else BytesIO(file_data)
+        with STAGE_SECONDS.time(stage=f"parse_{file_extension.lstrip('.')}"):
+            if missing is not None and len(missing) == 1:
+                parsed = {missing[0]: parser.return_work_shifts_and_working_keys(missing[0], file)}
+            else:
+                parsed = parser.return_work_shifts_for_signs(file, missing)
+
+        schedule = cache_parsed_signs(key, parsed, wanted is None)
+
+    if wanted is None:
+        return schedule
+    return {sign: schedule[normalized] for sign, normalized in wanted.items()}
+
+
+def init_worker():
+    # The pool already runs one job per core, so the OCR of a job does not start threads of its own
+    png_processing.OCR_MAX_WORKERS = 1
+
+
+def run_job(file_data, file_extension, sign):
+    # Runs in a worker process and returns when it started, the ICS file and the parsed shifts,
+    # so the parent process can cache them
+    started = time.time()
+    work_shifts, working_hours_dict = parse_schedule(file_data, file_extension, [sign])[sign]
+    return started, return_calendar(work_shifts, working_hours_dict), (work_shifts, working_hours_dict)
+
+
+class JobQueue:
+    """
+    Schedule parses that run in a pool of worker processes while the request returns at once.
+
+    Jobs are kept in memory by id until result_ttl seconds after they finished. With several WSGI worker
+    processes every process has its own queue, so the status must be polled on the same process, e.g.
+    with sticky sessions or a single process with threads. At most max_queued jobs are queued or running,
+    further jobs are refused. At most max_finished finished jobs are kept with their ICS files, the oldest
+    are forgotten first. The shifts parsed by a job are added to the schedule cache of this process.
+    """
+
+    def __init__(self, max_workers=None, result_ttl=60 * 60, max_queued=None, max_finished=100):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.result_ttl = result_ttl
+        self.max_queued = max_queued or 4 * self.max_workers
+        self.max_finished = max_finished
+        self.jobs = {}
+        # The ids of the finished jobs, the one that finished first at the front
+        self.finished = OrderedDict()
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.completed = 0
+        self.failed = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def _get_executor(self):
+        # Start the workers on the first job, so importing the module does not start processes.
+        # Spawn instead of fork, since forking a process with running threads can deadlock the child.
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=init_worker)
+            return self.executor
+
+    def submit(self, file_data, file_extension, sign):
+        """Queue a parse and return the id of the job, or None if max_queued jobs are already waiting"""
+        self._prune()
+        job_id = uuid.uuid4().hex
+        job = {'status': 'queued', 'sign': sign, 'submitted': time.time(), 'started': None, 'finished': None,
+               'error': None, 'ics': None, 'upload_key': make_upload_key(file_data, file_extension)}
+        with self.lock:
+            if sum(1 for queued in self.jobs.values() if queued['finished'] is None) >= self.max_queued:
+                return None
+            self.jobs[job_id] = job
+
+        # The pool sends the arguments to the worker after the request has closed the upload, so copy its bytes now
+        if hasattr(file_data, 'getvalue'):
+            file_data = file_data.getvalue()
+
+        executor = self._get_executor()
+        future = executor.submit(run_job, file_data, file_extension, sign)
+        with self.lock:
+            self.futures[job_id] = future
+        future.add_done_callback(lambda future: self._finish(job_id, future, executor))
+        return job_id
+
+    def _finish(self, job_id, future, executor):
+        finished = time.time()
+        shifts = None
+        with self.lock:
+            # A worker that died breaks the pool, so start a new one for the next job
+            if isinstance(future.exception(), BrokenProcessPool) and self.executor is executor:
+                self.executor = None
+
+            self.futures.pop(job_id, None)
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job['finished'] = finished
+            try:
+                job['started'], job['ics'], shifts = future.result()
+                job['status'] = 'done'
+                self.completed += 1
+            except Exception as e:
+                job['status'] = 'failed'
+                job['error'] = f"{type(e).__name__}: {e}"
+                self.failed += 1
+            latency = finished - job['submitted']
+            JOB_SECONDS.observe(latency, status=job['status'])
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if job['started'] is not None:
+                self.total_wait += job['started'] - job['submitted']
+            self.finished[job_id] = None
+            self._evict()
+
+        # The worker's cache is lost with the worker, so keep the shifts in this process for the next request
+        if shifts is not None:
+            cache_parsed_signs(job['upload_key'], {normalize_sign(job['sign']): shifts})
+
+    def _evict(self, now=None):
+        # Forget the oldest finished jobs beyond max_finished and, given the time, the ones kept for result_ttl
+        # seconds. Called with the lock held.
+        while self.finished:
+            job_id = next(iter(self.finished))
+            if len(self.finished) <= self.max_finished and \
+                    (now is None or now - self.jobs[job_id]['finished'] <= self.result_ttl):
+                break
+            del self.finished[job_id]
+            del self.jobs[job_id]
+
+    def _prune(self):
+        with self.lock:
+            self._evict(time.time())
+
+    def get(self, job_id):
+        """Get a job by its id, or None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+            # The pool hands a job to a worker when its future starts running
+            future = self.futures.get(job_id)
+            if job['status'] == 'queued' and future is not None and future.running():
+                job['status'] = 'running'
+            return job
+
+    def status(self, job_id):
+        """Get the status of a job without its ICS file, or None"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        status = {key: value for key, value in job.items() if key not in ('ics', 'upload_key')}
+        if job['finished'] is not None:
+            status['latency'] = job['finished'] - job['submitted']
+        return status
+
+    def stats(self):
+        with self.lock:
+            queued = sum(1 for job in self.jobs.values() if job['finished'] is None)
+            finished = self.completed + self.failed
+            return {'queue_depth': queued, 'workers': self.max_workers, 'completed': self.completed,
+                    'failed': self.failed,
+                    'average_wait': self.total_wait / self.completed if self.completed else None,
+                    'average_latency': self.total_latency / finished if finished else None,
+                    'max_latency': self.max_latency if finished else None}
+
+
+# The queue used by main. JOB_WORKERS sets the number of worker processes, JOB_QUEUE_SIZE the number of
+# jobs that can wait or run at the same time and JOB_RESULTS_SIZE the number of finished jobs that are kept.
+job_queue = JobQueue(max_workers=int(os.environ.get('JOB_WORKERS', 0)) or None,
+                     result_ttl=float(os.environ.get('JOB_RESULT_TTL', 60 * 60)),
+                     max_queued=int(os.environ.get('JOB_QUEUE_SIZE', 0)) or None,
+                     max_finished=int(os.environ.get('JOB_RESULTS_SIZE', 100)))
+
+metrics.gauge('job_queue_depth', 'Async jobs that are queued or running.',
+              lambda: job_queue.stats()['queue_depth'])
@@ -0,0 +1,34 @@
+import json
+import os
+import time
+
+from cache_store import LruDict, write_json, prune_directory
+
+
+def test_lru_dict_drops_the_least_recently_used_item():
+    entries = LruDict(2, [('a', 1), ('b', 2)])
+    assert entries.get('a') == 1
+    entries.set('c', 3)
+    assert 'b' not in entries
+    assert entries.items() == [('a', 1), ('c', 3)]
+
+
+def test_write_json_leaves_no_temporary_file(tmp_path):
+    path = tmp_path / 'data.json'
+    write_json(str(path), {'a': [1, 2]})
+    assert json.loads(path.read_text()) == {'a': [1, 2]}
+    assert os.listdir(tmp_path) == ['data.json']
+
+
+def test_prune_directory_keeps_the_newest_files(tmp_path):
+    now = time.time()
+    for index, name in enumerate(['old', 'middle', 'new']):
+        directory = tmp_path / name[:2]
+        directory.mkdir()
+        path = directory / f'{name}.json'
+        path.write_text('{}')
+        os.utime(path, (now - 10 + index, now - 10 + index))
+    prune_directory(str(tmp_path), 2)
+    assert sorted(path.name for path in tmp_path.rglob('*.json')) == ['middle.json', 'new.json']
+    prune_directory(str(tmp_path), 2, max_age=8.5)
+    assert [path.name for path in tmp_path.rglob('*.json')] == ['new.json']
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import pytest
+
+import cal_functions
+import pdf_processing
+from cal_functions import Shift, LOCAL_TZ
+
+
+def make_shift(day, start_hour, end_hour, description='Arbetspass', month=3):
+    return Shift(datetime(2023, month, day, start_hour, tzinfo=LOCAL_TZ),
+                 datetime(2023, month, day, end_hour, tzinfo=LOCAL_TZ), description, '12')
+
+
+def unfold(text):
+    return text.replace('\r\n ', '')
+
+
+def test_fold_line_keeps_a_multibyte_character_whole():
+    # 'Ö' is two octets and would end at octet 76, so it starts the continuation line
+    line = 'SUMMARY:' + 'a' * 66 + 'Ö' + 'b' * 100
+    folded = cal_functions.fold_line(line)
+    physical_lines = folded[:-2].split('\r\n')
+    assert physical_lines[0] == 'SUMMARY:' + 'a' * 66
+    assert physical_lines[1].startswith(' Ö')
+    assert all(len(physical_line.encode('utf-8')) <= 75 for physical_line in physical_lines)
+    assert folded.endswith('\r\n') and unfold(folded) == line + '\r\n'
+
+
+def test_fold_line_leaves_short_lines():
+    line = 'SUMMARY:' + 'a' * 67
+    assert cal_functions.fold_line(line) == line + '\r\n'
+
+
+def test_escape_text():
+    assert cal_functions.escape_text('a,b;c\\d\ne\r\nf') == 'a\\,b\\;c\\\\d\\ne\\nf'
+
+
+def test_generate_ics_writes_utc_times():
+    # Stockholm is UTC+1 in winter and UTC+2 in summer
+    ics = ''.join(cal_functions.generate_ics([make_shift(10, 7, 16, month=1), make_shift(10, 7, 16, month=7)]))
+    assert 'DTSTART:20230110T060000Z\r\n' in ics
+    assert 'DTEND:20230110T150000Z\r\n' in ics
+    assert 'DTSTART:20230710T050000Z\r\n' in ics
+    assert ics.startswith('BEGIN:VCALENDAR\r\nVERSION:2.0\r\n') and ics.endswith('END:VCALENDAR\r\n')
+
+
+def test_generate_ics_writes_a_shift_once():
+    shifts = [make_shift(10, 7, 16), make_shift(10, 7, 16), make_shift(10, 7, 16, 'FM-dygn'), make_shift(11, 7, 16)]
+    ics = ''.join(cal_functions.generate_ics(shifts))
+    assert ics.count('BEGIN:VEVENT') == 3
+    uids = [line for line in ics.split('\r\n') if line.startswith('UID:')]
+    assert len(set(uids)) == 3
+
+
+def test_generate_ics_of_planering_pdf_parses():
+    ics = pytest.importorskip('ics')
+    events = 0
+    for work_shifts, working_hours_dict in pdf_processing.return_work_shifts_for_signs('planering.pdf').values():
+        text = ''.join(cal_functions.generate_ics(cal_functions.build_shifts(work_shifts, working_hours_dict, 2023)))
+        assert all(len(line.encode('utf-8')) <= 75 for line in text.split('\r\n'))
+        events += len(ics.Calendar(text).events)
+    assert events == 728
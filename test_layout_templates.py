@@ -0,0 +1,22 @@
+import pdfplumber
+
+import layout_templates
+
+
+def test_pages_of_one_format_share_a_fingerprint_but_not_their_layout(tmp_path):
+    store = layout_templates.LayoutStore(str(tmp_path / 'layouts.json'))
+    with pdfplumber.open('planering72.pdf') as pdf:
+        second, third = pdf.pages[1], pdf.pages[2]
+        # The two pages have the same grid format with the rows in other places
+        assert layout_templates.pdf_page_fingerprint(second) == layout_templates.pdf_page_fingerprint(third)
+
+        store.learn_pdf_layout(second, second.find_tables())
+        assert store.find_pdf_layout(second) is not None
+        assert store.find_pdf_layout(third) is None
+
+        # Both layouts are kept under the fingerprint and read back from the file
+        store.learn_pdf_layout(third, third.find_tables())
+        stored = layout_templates.LayoutStore(str(tmp_path / 'layouts.json'))
+        assert stored.find_pdf_layout(second) == [[list(cell) for cell in table.cells]
+                                                  for table in second.find_tables()]
+        assert stored.find_pdf_layout(third) is not None
@@ -0,0 +1,11 @@
+from ocr_cache import OcrCache, MISS
+
+
+def test_disk_tier_is_pruned(tmp_path):
+    cache = OcrCache(max_entries=5, directory=str(tmp_path), max_disk_entries=20)
+    for index in range(50):
+        cache.set(f'{index:04x}', index)
+    assert len(list(tmp_path.rglob('*.json'))) <= 20
+    # The newest results are still on disk
+    assert OcrCache(directory=str(tmp_path)).get(f'{49:04x}') == 49
+    assert OcrCache(directory=str(tmp_path)).get(f'{0:04x}') is MISS
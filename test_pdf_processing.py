@@ -0,0 +1,33 @@
+import pytest
+
+import pdf_processing
+
+PDF_PATH = 'planering.pdf'
+
+
+@pytest.fixture(scope='module')
+def all_signs():
+    return pdf_processing.return_work_shifts_for_signs(PDF_PATH)
+
+
+def test_batch_finds_every_signature(all_signs):
+    assert len(all_signs) == 19
+
+
+def test_batch_matches_single_signature_parse(all_signs):
+    # One parse of the whole schedule gives the same shifts as parsing it once per signature
+    for sign, result in all_signs.items():
+        assert result == pdf_processing.return_work_shifts_and_working_keys(sign, PDF_PATH), sign
+
+
+def test_batch_with_signs_matches_single_signature_parse(all_signs):
+    signs = sorted(all_signs)[:2]
+    results = pdf_processing.return_work_shifts_for_signs(PDF_PATH, signs)
+    assert sorted(results) == signs
+    for sign in signs:
+        assert results[sign] == pdf_processing.return_work_shifts_and_working_keys(sign, PDF_PATH)
+
+
+def test_batch_with_unknown_sign_raises():
+    with pytest.raises(ValueError):
+        pdf_processing.return_work_shifts_for_signs(PDF_PATH, ['XYZ'])
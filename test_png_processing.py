@@ -0,0 +1,114 @@
+import numpy as np
+
+import png_processing
+
+
+def make_cell(x, y, width, height):
+    return [(x, y), (x + width, y), (x, y + height), (x + width, y + height)]
+
+
+
+def reference_white_runs(image, min_length):
+    # Walk every row pixel by pixel, like detect_lines did before it was vectorized
+    runs = []
+    for row in range(image.shape[0]):
+        start = None
+        for col in range(image.shape[1] + 1):
+            white = col < image.shape[1] and image[row, col] == 255
+            if white and start is None:
+                start = col
+            elif not white and start is not None:
+                if col - start >= min_length:
+                    runs.append((row, start, col))
+                start = None
+    return runs
+
+
+def make_grid_image():
+    # Two thick horizontal lines, three vertical lines, a short dash and some noise
+    image = np.zeros((60, 80), np.uint8)
+    image[5:8, 2:78] = 255
+    image[50, 2:78] = 255
+    for x in (2, 40, 77):
+        image[5:51, x] = 255
+    image[30, 10:14] = 255
+    image[20, 60] = 255
+    return image
+
+
+def test_find_white_runs_matches_reference():
+    rng = np.random.default_rng(1)
+    for image in (make_grid_image(), np.where(rng.random((40, 50)) < 0.7, 255, 0).astype(np.uint8)):
+        for min_length in (1, 3, 30):
+            rows, starts, ends = png_processing.find_white_runs(image, min_length)
+            assert list(zip(rows.tolist(), starts.tolist(), ends.tolist())) == \
+                reference_white_runs(image, min_length)
+
+
+def test_detect_lines_finds_the_grid():
+    horizontal, vertical = png_processing.detect_lines(make_grid_image(), 20, 20)
+    assert png_processing.merge_lines(horizontal, True).tolist() == [(5, 3, 2, 78), (50, 1, 2, 78)]
+    assert png_processing.merge_lines(vertical, False).tolist() == [(2, 1, 5, 51), (40, 1, 5, 51),
+                                                                    (77, 1, 5, 51)]
+
+def test_find_empty_cells_matches_is_cell_empty_on_a_large_page():
+    # A page above 2**31 / 255 pixels, where 32 bit integral images would overflow
+    rng = np.random.default_rng(0)
+    image = np.full((3000, 3000), 240, np.uint8)
+    image[:, ::7] = rng.integers(0, 256, (3000, 429), dtype=np.uint8)
+    image[1000:1500, 1000:2000] = 250
+    cells = [make_cell(*rng.integers(0, 2900, 2), *rng.integers(1, 100, 2)) for _ in range(200)]
+    cells.append(make_cell(1100, 1100, 100, 50))
+
+    empty = png_processing.find_empty_cells(image, cells)
+    expected = [png_processing.is_cell_empty(image[cell[0][1]:cell[3][1], cell[0][0]:cell[3][0]])
+                for cell in cells]
+    assert empty.tolist() == expected
+    assert empty[-1]
+
+
+def make_lines(runs):
+    return np.array(runs, dtype=png_processing.LINE_DTYPE)
+
+
+def test_merge_lines_keeps_a_thick_line_whole_next_to_a_thin_one():
+    # A thin line that starts while a thick line is open must not split the thick line in two
+    runs = [(row, 1, 0, 1000) for row in range(31)] + [(5, 1, 2000, 2100)]
+    assert png_processing.merge_lines(make_lines(runs)).tolist() == [(0, 31, 0, 1000), (5, 1, 2000, 2100)]
+
+
+def test_merge_lines_joins_lines_bridged_by_a_run():
+    # Two parts of a line that only meet on a later row are one line
+    runs = [(0, 1, 0, 100), (0, 1, 300, 400), (1, 1, 90, 310)]
+    assert png_processing.merge_lines(make_lines(runs)).tolist() == [(0, 2, 0, 400)]
+
+
+
+def test_merge_lines_joins_adjacent_and_overlapping_runs():
+    runs = [(10, 1, 0, 100), (11, 1, 50, 200), (12, 1, 205, 300),
+            # Too far below to be part of the same line
+            (40, 1, 0, 100),
+            # Too short to be kept
+            (60, 1, 0, 5)]
+    assert png_processing.merge_lines(make_lines(runs)).tolist() == [(10, 3, 0, 300), (40, 1, 0, 100)]
+
+
+def make_grid_cells(x_coords, y_coords):
+    return [[(x0, y0), (x1, y0), (x0, y1), (x1, y1)]
+            for y0, y1 in zip(y_coords, y_coords[1:]) for x0, x1 in zip(x_coords, x_coords[1:])]
+
+
+def test_grid_index_finds_cells_by_coordinate():
+    cells = make_grid_cells([0, 30, 70, 100], [0, 20, 45])
+    # A merged cell spanning the last two columns of the second row
+    cells = cells[:4] + [[(30, 20), (100, 20), (30, 45), (100, 45)]]
+    grid = png_processing.GridIndex(cells)
+
+    for x in range(0, 100, 7):
+        for y in range(0, 45, 4):
+            expected = [cell for cell in cells if cell[0][0] <= x < cell[3][0] and cell[0][1] <= y < cell[3][1]]
+            assert grid.cell_at(x, y) == (expected[0] if expected else None), (x, y)
+    assert grid.cell_at(150, 10) is None
+    assert grid.cells_on_row(0) == cells[:3]
+    assert grid.cells_on_row(0, after_column=0) == cells[1:3]
+    assert grid.cells_on_row(1) == cells[3:]
@@ -0,0 +1,53 @@
+from concurrent.futures import Future
+
+import pytest
+
+import pdf_processing
+import schedule_jobs
+from schedule_cache import schedule_cache
+
+PDF_PATH = 'planering.pdf'
+
+
+@pytest.fixture
+def pdf_data():
+    schedule_cache.clear()
+    with open(PDF_PATH, 'rb') as file:
+        yield file.read()
+    schedule_cache.clear()
+
+
+def test_single_sign_uses_the_targeted_parse(pdf_data, monkeypatch):
+    # One missing signature is parsed on its own pages only, not with the whole schedule
+    def parse_all(*args, **kwargs):
+        raise AssertionError("parsed every signature for one")
+
+    monkeypatch.setattr(pdf_processing, 'return_work_shifts_for_signs', parse_all)
+    result = schedule_jobs.parse_schedule(pdf_data, '.pdf', ['dof '])
+    assert list(result) == ['dof ']
+    assert result['dof '] == pdf_processing.return_work_shifts_and_working_keys('DOF', PDF_PATH)
+
+
+def test_cached_signs_are_not_parsed_again(pdf_data, monkeypatch):
+    schedule = schedule_jobs.parse_schedule(pdf_data, '.pdf')
+
+    def parse(*args, **kwargs):
+        raise AssertionError("parsed a cached schedule")
+
+    monkeypatch.setattr(pdf_processing, 'return_work_shifts_for_signs', parse)
+    monkeypatch.setattr(pdf_processing, 'return_work_shifts_and_working_keys', parse)
+    signs = sorted(schedule)[:2]
+    assert schedule_jobs.parse_schedule(pdf_data, '.pdf', signs) == {sign: schedule[sign] for sign in signs}
+
+
+def test_job_queue_keeps_max_finished_jobs():
+    job_queue = schedule_jobs.JobQueue(max_workers=1, max_finished=2)
+    for job_id in ['a', 'b', 'c']:
+        job_queue.jobs[job_id] = {'status': 'queued', 'sign': 'DOF', 'submitted': 0.0, 'started': None,
+                                  'finished': None, 'error': None, 'ics': None, 'upload_key': None}
+        future = Future()
+        future.set_exception(ValueError("No row found"))
+        job_queue._finish(job_id, future, None)
+    # The job that finished first is forgotten
+    assert job_queue.get('a') is None
+    assert [job_queue.get(job_id)['status'] for job_id in ['b', 'c']] == ['failed', 'failed']